@@ -0,0 +1,54 @@
+import numpy as np
+from src import map_data
+
+##
+# Evaluates formulas that combine maps node by node (eg. PSL from POP & TBI) a block of nodes at a time
+#
+# A formula is a function taking the named input values and returning the output values, eg.
+#   lambda population, elevation: np.where(population > 0, population, -np.abs(elevation))
+# It is written for whole arrays, but only ever called on one block (block_size x block_size nodes) at a time,
+# so its temporaries stay small enough to fit in the cache no matter how large the maps are.
+#
+# The inputs are read, and the output produced, as bands of rows (eg. map_data.iterWorldBands),
+# so the output can be streamed to disk (see saveFormulaTiles) without any full map ever being in memory.
+#
+default_block_size = 256
+
+# Yields the output of the formula a band of rows at a time
+# inputs maps names of the formula's arguments to iterators of bands, which must all have the same rows
+def iterFormulaBands(formula, inputs, n_cols, block_size=default_block_size, dtype=float):
+    names = list(inputs)
+    for bands in zip(*[inputs[name] for name in names]):
+        band_output = np.empty(bands[0].shape, dtype=dtype)
+        for ymin in range(0, band_output.shape[0], block_size):
+            for xmin in range(0, n_cols, block_size):
+                block = (slice(ymin, ymin + block_size), slice(xmin, xmin + block_size))
+                band_output[block] = formula(**{name: band[block] for name, band in zip(names, bands)})
+        yield band_output
+
+# The bands of a map already in memory, to use it as an input
+def iterMapBands(map_instance, n_band_rows=map_data.default_tile_size):
+    gridded_data = map_instance.getDataMatrix()
+    for ymin in range(0, map_instance.getNumRows(), n_band_rows):
+        yield gridded_data[ymin:ymin + n_band_rows]
+
+# Evaluates the formula over world maps & saves the output in the tiled format as it goes (see map_data.saveTileBands)
+# inputs maps names of the formula's arguments to datasets, eg. {'population': 'POP', 'elevation': 'TBI'}
+def saveFormulaTiles(formula, inputs, dataset_output, minutes_per_node, tile_size=map_data.default_tile_size,
+                     compressed=False, n_processes=None, block_size=default_block_size, dtype=float):
+    n_rows = 180 * 60 // minutes_per_node
+    n_cols = 360 * 60 // minutes_per_node
+    map_data.saveTileBands(
+        iterFormulaBands(formula, getWorldInputs(inputs, minutes_per_node, tile_size), n_cols, block_size, dtype),
+        n_rows, n_cols, np.dtype(dtype), dataset_output, minutes_per_node, tile_size, compressed, n_processes,
+    )
+
+# Evaluates the formula over world maps into one array
+def getFormulaWorld(formula, inputs, minutes_per_node, block_size=default_block_size, dtype=float):
+    n_cols = 360 * 60 // minutes_per_node
+    return np.concatenate(list(iterFormulaBands(
+        formula, getWorldInputs(inputs, minutes_per_node), n_cols, block_size, dtype,
+    )))
+
+def getWorldInputs(inputs, minutes_per_node, n_band_rows=map_data.default_tile_size):
+    return {name: map_data.iterWorldBands(dataset, minutes_per_node, n_band_rows) for name, dataset in inputs.items()}
@@ -0,0 +1,317 @@
+##
+# Times & memory-profiles each stage of a LocalePartition, to catch regressions and measure speedups
+#
+#   python -m src.map_benchmark run --output benchmark.json
+#   python -m src.map_benchmark run --cases synthetic_16m --repeats 3 --output after.json
+#   python -m src.map_benchmark compare benchmark.json after.json
+#
+# Cases run on the bundled 60 minute data, a few regions, and synthetic elevation maps (see getSyntheticElevation)
+# that can be made as large as needed without any data files. Every case is run from an empty map_cache.
+# The regions are only a few hundred nodes at 60 minutes, so the region path is also measured at 10 minutes
+# (the bundled population data), and at 5 & 10 minutes of elevation data once those files have been made
+# (see map_input_processing.createCoarserResolutionFiles), which aren't run by default.
+# Memory is the peak of the allocations made during the stage (tracemalloc, which numpy reports to), measured in a
+# separate run since tracing slows some stages down. It doesn't include what earlier stages are still holding,
+# nor the memory of any worker processes.
+#
+# Results are saved as JSON, and compare flags the stages that got slower than the baseline (exiting with 1).
+#
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from src import map_partition, map_transforms, map_instance, map_cache
+
+benchmark_cases = {
+    'world_60min_tbi': {'dataset': 'TBI', 'region': 'world', 'minutes_per_node': 60},
+    'world_60min_psl': {'dataset': 'PSL', 'region': 'world', 'minutes_per_node': 60},
+    'hawaii_60min_tbi': {'dataset': 'TBI', 'region': 'hawaii', 'minutes_per_node': 60},
+    'cascadia_60min_tbi': {'dataset': 'TBI', 'region': 'cascadia', 'minutes_per_node': 60},
+    'australia_60min_tbi': {'dataset': 'TBI', 'region': 'australia', 'minutes_per_node': 60},
+    'australia_10min_pop': {'dataset': 'POP', 'region': 'australia', 'minutes_per_node': 10},
+    'cascadia_5min_tbi': {'dataset': 'TBI', 'region': 'cascadia', 'minutes_per_node': 5},
+    'australia_10min_tbi': {'dataset': 'TBI', 'region': 'australia', 'minutes_per_node': 10},
+    'synthetic_1m': {'synthetic_dims': (1024, 1024)},
+    'synthetic_16m': {'synthetic_dims': (4096, 4096)},
+    'synthetic_256m': {'synthetic_dims': (16384, 16384)},
+}
+default_case_names = [name for name in benchmark_cases
+                      if name not in ['cascadia_5min_tbi', 'australia_10min_tbi', 'synthetic_256m']]
+default_threshold = 0.25 # slowdowns of more than 25% are flagged
+default_min_seconds = 0.01 # stages faster than this in both runs are too noisy to flag
+
+##
+# Synthetic elevation maps: fractal value noise, the sum of octaves of smoothly interpolated random lattices
+# where each octave has half the cell size and roughness times the amplitude of the one before it
+#
+# The lattice values come from a hash of (seed, octave, lattice row, lattice col) rather than a random generator,
+# so the map is the same for a seed whatever bands it is made in, and each band is made on its own.
+# Nodes are about half land and half sea, up to roughly +-max_elevation.
+#
+def iterSyntheticElevationBands(n_rows, n_cols, seed=0, roughness=0.55, max_elevation=6000,
+                                n_band_rows=256, dtype=np.float32):
+    cells_size = [2**i for i in range(int(np.ceil(np.log2(max(n_rows, n_cols, 4) / 4))), -1, -1)]
+    octaves_amplitude = roughness ** np.arange(len(cells_size))
+    scale = max_elevation * 2 / np.sum(octaves_amplitude)
+    octaves_cols = [_getLatticeWeights(np.arange(n_cols), cell_size) for cell_size in cells_size]
+
+    for ymin in range(0, n_rows, n_band_rows):
+        band_rows = np.arange(ymin, min(ymin + n_band_rows, n_rows))
+        band = np.zeros([len(band_rows), n_cols], dtype=dtype)
+        for i_octave, cell_size in enumerate(cells_size):
+            rows_lattice, rows_weight = _getLatticeWeights(band_rows, cell_size)
+            cols_lattice, cols_weight = octaves_cols[i_octave]
+            lattice_row_min = rows_lattice[0]
+            lattice = _getLatticeValues(
+                seed, i_octave,
+                np.arange(lattice_row_min, rows_lattice[-1] + 2),
+                np.arange(cols_lattice[-1] + 2),
+            )
+            # Interpolate down the rows, then across the columns
+            rows_lattice = rows_lattice - lattice_row_min
+            lattice = lattice[rows_lattice] * (1 - rows_weight[:, None]) + lattice[rows_lattice + 1] * rows_weight[:, None]
+            band += (octaves_amplitude[i_octave] * scale) * \
+                (lattice[:, cols_lattice] * (1 - cols_weight) + lattice[:, cols_lattice + 1] * cols_weight)
+        yield band
+
+def getSyntheticElevation(n_rows, n_cols, seed=0, minutes_per_node=1, image_folder=None, **kwargs):
+    data = np.empty(n_rows * n_cols, dtype=kwargs.get('dtype', np.float32))
+    n_nodes_done = 0
+    for band in iterSyntheticElevationBands(n_rows, n_cols, seed, **kwargs):
+        data[n_nodes_done:n_nodes_done + band.size] = band.reshape(-1)
+        n_nodes_done += band.size
+    return map_instance.MapInstance({
+        'minutes_per_node': minutes_per_node,
+        'dataset': 'tbi',
+        'image_folder': image_folder,
+        'region': getSyntheticRegion(n_rows, n_cols, seed),
+    }, n_rows, n_cols, data)
+
+def getSyntheticRegion(n_rows, n_cols, seed=0):
+    return 'synthetic_{}x{}_seed{}'.format(n_rows, n_cols, seed)
+
+# The lattice cell before each position & how far along the cell it is (smoothed so the slopes are continuous)
+def _getLatticeWeights(positions, cell_size):
+    positions_lattice = positions // cell_size
+    positions_weight = (positions % cell_size) / cell_size
+    return positions_lattice, positions_weight * positions_weight * (3 - 2 * positions_weight)
+
+# Values in [-1, 1) for every lattice point, hashed from its position
+def _getLatticeValues(seed, i_octave, lattice_rows, lattice_cols):
+    mask = np.uint64(0xFFFFFFFF)
+    hashes = (lattice_rows.astype(np.uint64)[:, None] * np.uint64(0x9E3779B1)) ^ \
+        (lattice_cols.astype(np.uint64)[None, :] * np.uint64(0x85EBCA77)) ^ \
+        np.uint64((seed * 0xC2B2AE3D + i_octave * 0x27D4EB2F) & 0xFFFFFFFF)
+    for shift, multiplier in [(15, 0x2C1B3C6D), (12, 0x297A2D39), (15, 0x165667B1)]:
+        hashes = ((hashes ^ (hashes >> np.uint64(shift))) * np.uint64(multiplier)) & mask
+    return ((hashes >> np.uint64(8)).astype(np.float32) / 2**23 - 1)
+
+##
+# Running the benchmarks
+#
+# Returns the results as a dict: the environment they were run in, and one row per case & stage
+#
+def runBenchmarks(case_names=None, n_repeats=1, flow_direction='up', n_neighbors=4, n_processes=1,
+                  track_memory=True, image_folder=None, verbose=True):
+    if case_names is None:
+        case_names = default_case_names
+    for case_name in case_names:
+        assert (case_name in benchmark_cases), 'Benchmark case must be one of: ' + str(list(benchmark_cases))
+
+    # The images drawn along the way are timed too, but only kept if there's a folder for them
+    image_folder_temp = None
+    if image_folder is None:
+        image_folder_temp = tempfile.mkdtemp(prefix='map_benchmark_')
+        image_folder = image_folder_temp + '/'
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'n_cpus': os.cpu_count(),
+        },
+        'settings': {
+            'n_repeats': n_repeats,
+            'flow_direction': flow_direction,
+            'n_neighbors': n_neighbors,
+            'n_processes': n_processes,
+            'track_memory': track_memory,
+        },
+        'results': [],
+    }
+    try:
+        for case_name in case_names:
+            # tracemalloc slows down the stages that make many small allocations (eg. the merge sweep) several times,
+            # so the times come from the fastest of the untraced repeats and the peaks from a traced run of their own
+            cases_stages = [
+                _runCase(benchmark_cases[case_name], flow_direction, n_neighbors, n_processes, False, image_folder)
+                for _ in range(n_repeats)
+            ]
+            if track_memory:
+                stages_traced = _runCase(benchmark_cases[case_name], flow_direction, n_neighbors, n_processes, True, image_folder)
+            for i_stage, stage in enumerate(cases_stages[0]):
+                stage = dict(stage, case=case_name)
+                stage['seconds'] = min(stages[i_stage]['seconds'] for stages in cases_stages)
+                stage['peak_bytes'] = stages_traced[i_stage]['peak_bytes'] if track_memory else None
+                results['results'].append(stage)
+                if verbose:
+                    print('{:22s} {:28s} {:>12} nodes {:9.3f}s {:>10s}'.format(
+                        case_name, stage['stage'], stage['n_nodes'], stage['seconds'],
+                        '-' if stage['peak_bytes'] is None else '{:.1f}MB'.format(stage['peak_bytes'] / 2**20)))
+    finally:
+        if image_folder_temp is not None:
+            shutil.rmtree(image_folder_temp, ignore_errors=True)
+        map_cache.clear()
+    return results
+
+def _runCase(case, flow_direction, n_neighbors, n_processes, track_memory, image_folder):
+    map_cache.clear()
+    stages = []
+
+    def measure(stage, compute):
+        if track_memory:
+            tracemalloc.start()
+        time_start = time.perf_counter()
+        value = compute()
+        seconds = time.perf_counter() - time_start
+        peak_bytes = None
+        if track_memory:
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        stages.append({'stage': stage, 'seconds': seconds, 'peak_bytes': peak_bytes})
+        return value
+
+    if 'synthetic_dims' in case:
+        n_rows, n_cols = case['synthetic_dims']
+        map_elevation = measure('getSyntheticElevation', lambda: getSyntheticElevation(n_rows, n_cols))
+        partition = map_partition.LocalePartition(
+            'TBI', map_elevation.getAttribute('region'), 1, image_folder, flow_direction, n_neighbors,
+            n_processes=n_processes, display_images=False, map_elevation=map_elevation,
+        )
+    else:
+        partition = map_partition.LocalePartition(
+            case['dataset'], case['region'], case['minutes_per_node'], image_folder, flow_direction, n_neighbors,
+            n_processes=n_processes, display_images=False,
+        )
+
+    # The stages of computeStandardDivisionInformation, without drawing
+    measure('computeBaseMaps', lambda: partition.computeBaseMaps(display_and_save_image=False))
+    measure('computeNodeNeighbors', partition.computeNodeNeighbors)
+    measure('computeDivisionMergePoints', lambda: partition.computeDivisionMergePoints(draw_and_save_image=False))
+    measure('computePaths', partition.computePaths)
+    measure('computePathInterfaceType', partition.computePathInterfaceType)
+    measure('getLocaleAdjacencyList', partition.getLocaleAdjacencyList)
+    measure('drawDivisionsAcrossSeaLevel', partition.drawDivisionsAcrossSeaLevel)
+
+    # Then the transforms & images on their own
+    measure('getHillshade', lambda: map_transforms.getHillshade(partition.maps['elevation'], 1))
+    image = measure('RasterImage.getImageBase',
+                    lambda: partition.getImageBase(nodes_bg_value=partition.maps['locale'].getDataFlat()))
+    measure('RasterImage.save', image.save)
+    measure('RasterImage.savePyramid', lambda: image.savePyramid(nodes_skip=partition.maps['sea'].getDataFlat()))
+
+    n_nodes = int(partition.maps['elevation'].getNumNodes())
+    return [dict(stage, n_nodes=n_nodes) for stage in stages]
+
+def saveResults(results, filename):
+    results_file = open(filename, 'w')
+    json.dump(results, results_file, indent=1)
+    results_file.close()
+
+def loadResults(filename):
+    results_file = open(filename, 'r')
+    results = json.load(results_file)
+    results_file.close()
+    return results
+
+##
+# Compares two sets of results stage by stage
+#
+# Each row has the times & peaks of both, their ratio (current / baseline) and a status:
+# 'slower' if the time went up by more than the threshold, 'faster' if it went down by as much, otherwise ''
+# ('new' & 'missing' for stages only in one of them). Stages under min_seconds in both are never flagged.
+#
+def compareResults(baseline, current, threshold=default_threshold, min_seconds=default_min_seconds):
+    stages_baseline = {(row['case'], row['stage']): row for row in baseline['results']}
+    stages_current = {(row['case'], row['stage']): row for row in current['results']}
+
+    comparison = []
+    for key in list(stages_baseline) + [key for key in stages_current if key not in stages_baseline]:
+        row_baseline = stages_baseline.get(key)
+        row_current = stages_current.get(key)
+        row = {'case': key[0], 'stage': key[1], 'status': '', 'ratio': None}
+        for label, row_source in [('baseline', row_baseline), ('current', row_current)]:
+            row[label + '_seconds'] = None if row_source is None else row_source['seconds']
+            row[label + '_peak_bytes'] = None if row_source is None else row_source['peak_bytes']
+
+        if row_baseline is None:
+            row['status'] = 'new'
+        elif row_current is None:
+            row['status'] = 'missing'
+        else:
+            row['ratio'] = row_current['seconds'] / max(row_baseline['seconds'], 1e-9)
+            if max(row_current['seconds'], row_baseline['seconds']) >= min_seconds:
+                if row['ratio'] > 1 + threshold:
+                    row['status'] = 'slower'
+                elif row['ratio'] < 1 / (1 + threshold):
+                    row['status'] = 'faster'
+        comparison.append(row)
+    return comparison
+
+def printComparison(comparison):
+    print('{:22s} {:28s} {:>10s} {:>10s} {:>7s} {:>10s} {:>10s}  {}'.format(
+        'case', 'stage', 'base (s)', 'new (s)', 'ratio', 'base (MB)', 'new (MB)', 'status'))
+
+    def formatValue(value, scale=1):
+        return '-' if value is None else '{:.3f}'.format(value / scale)
+
+    for row in comparison:
+        print('{:22s} {:28s} {:>10s} {:>10s} {:>7s} {:>10s} {:>10s}  {}'.format(
+            row['case'], row['stage'],
+            formatValue(row['baseline_seconds']), formatValue(row['current_seconds']),
+            '-' if row['ratio'] is None else '{:.2f}x'.format(row['ratio']),
+            formatValue(row['baseline_peak_bytes'], 2**20), formatValue(row['current_peak_bytes'], 2**20),
+            row['status'],
+        ))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the stages of LocalePartition')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_run = subparsers.add_parser('run', help='run the benchmarks & save the results')
+    parser_run.add_argument('--cases', nargs='+', default=default_case_names, choices=list(benchmark_cases))
+    parser_run.add_argument('--output', default='benchmark.json')
+    parser_run.add_argument('--repeats', type=int, default=1)
+    parser_run.add_argument('--flow-direction', default='up', choices=['up', 'down'])
+    parser_run.add_argument('--n-neighbors', type=int, default=4)
+    parser_run.add_argument('--n-processes', type=int, default=1)
+    parser_run.add_argument('--no-memory', action='store_true', help='skip the extra run measuring memory')
+    parser_run.add_argument('--image-folder', default=None, help='keep the images drawn in this folder')
+
+    parser_compare = subparsers.add_parser('compare', help='flag the stages that got slower than a baseline')
+    parser_compare.add_argument('baseline')
+    parser_compare.add_argument('current')
+    parser_compare.add_argument('--threshold', type=float, default=default_threshold)
+    parser_compare.add_argument('--min-seconds', type=float, default=default_min_seconds)
+
+    args = parser.parse_args(args)
+    if args.command == 'run':
+        results = runBenchmarks(args.cases, args.repeats, args.flow_direction, args.n_neighbors, args.n_processes,
+                                not args.no_memory, args.image_folder)
+        saveResults(results, args.output)
+        return 0
+
+    comparison = compareResults(loadResults(args.baseline), loadResults(args.current), args.threshold, args.min_seconds)
+    printComparison(comparison)
+    return 1 if any(row['status'] == 'slower' for row in comparison) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+##
+# An in-memory cache of loaded maps and the maps derived from them (hillshade, sea, coast, locales, ...)
+#
+# Notebooks often run several partitions over the same dataset & region (eg. both flow directions),
+# and every one of them used to reload the world file and redo the same transforms.
+# Entries are keyed by (dataset, minutes_per_node, region, transform, params) and the least recently used
+# ones are dropped once the cache goes over its memory or entry limits.
+#
+# Cached map data is made read-only, since the same arrays are handed out to every caller.
+#
+from collections import OrderedDict
+import numpy as np
+from src.map_instance import MapInstance
+
+class MapCache():
+    def __init__(self, max_bytes=2**31, max_entries=64):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (value, n_bytes), least recently used first
+        self.n_bytes = 0
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_evictions = 0
+
+    # Returns the cached value for the key, otherwise computes it with compute() and caches it
+    def getOrCompute(self, key, compute):
+        if key in self.entries:
+            self.n_hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+        self.n_misses += 1
+        value = compute()
+        n_bytes = _getSize(value)
+        if n_bytes <= self.max_bytes and self.max_entries > 0:
+            _setReadOnly(value)
+            self.entries[key] = (value, n_bytes)
+            self.n_bytes += n_bytes
+            self._evict()
+        return value
+
+    def setLimits(self, max_bytes=None, max_entries=None):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if max_entries is not None:
+            self.max_entries = max_entries
+        self._evict()
+        return self
+
+    def clear(self):
+        self.entries.clear()
+        self.n_bytes = 0
+        return self
+
+    def getStats(self):
+        return {
+            'hits': self.n_hits,
+            'misses': self.n_misses,
+            'evictions': self.n_evictions,
+            'entries': len(self.entries),
+            'bytes': self.n_bytes,
+        }
+
+    def _evict(self):
+        while len(self.entries) > 0 and (self.n_bytes > self.max_bytes or len(self.entries) > self.max_entries):
+            _key, (_value, n_bytes) = self.entries.popitem(last=False)
+            self.n_bytes -= n_bytes
+            self.n_evictions += 1
+
+# The cache shared by map_data & map_partition
+default_cache = MapCache()
+
+def getOrCompute(key, compute):
+    return default_cache.getOrCompute(key, compute)
+
+def setLimits(max_bytes=None, max_entries=None):
+    return default_cache.setLimits(max_bytes, max_entries)
+
+def clear():
+    return default_cache.clear()
+
+def getStats():
+    return default_cache.getStats()
+
+def _getSize(value):
+    if isinstance(value, MapInstance):
+        return _getSize(value.data)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(_getSize(value[key]) for key in value)
+    return 0
+
+def _setReadOnly(value):
+    if isinstance(value, MapInstance):
+        _setReadOnly(value.data)
+    elif isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, dict):
+        for key in value:
+            _setReadOnly(value[key])
@@ -1,14 +1,60 @@
+import json
+import multiprocessing
+import os
 import numpy as np
 from src.map_instance import *
+from src import map_cache
 
 allowed_minute_input = [1, 5, 10, 60]
 allowed_dataset_input = ['TBI', 'POP', 'PSL']
+default_tile_size = 256
 
+##
+# Loaded maps are kept in map_cache, so loading the same dataset & region again is free.
+# The cached maps are shared, so each caller gets its own MapInstance (with its image folder) around the same data.
+#
 def loadBaseMap(dataset, minutes_per_node, image_folder):
-    # Validate Input
+    _validateInput(dataset, minutes_per_node)
+    world_map = map_cache.getOrCompute(
+        (dataset, minutes_per_node, 'world', 'load', ()),
+        lambda: _loadBaseMapUncached(dataset, minutes_per_node),
+    )
+    return _setImageFolder(world_map, image_folder)
+
+def loadRegionMap(region, dataset, minutes_per_node, image_folder):
+    region_bounds = _loadRegionBounds(region, minutes_per_node)
+    return loadRegionMapFromBounds(region, region_bounds, dataset, minutes_per_node, image_folder)
+
+##
+# Loads the map for any region, given its bounds in the same resolution as the data
+#
+# If the dataset has been converted to tiles (see convertNPZToTiles) only the tiles that the region
+# touches are read, otherwise the whole world map is loaded and cut down to the region. A .npz can't be read
+# in parts, so without tiles every region load decompresses the whole world (once, it's then kept in map_cache).
+#
+def loadRegionMapFromBounds(region, region_bounds, dataset, minutes_per_node, image_folder):
+    _validateInput(dataset, minutes_per_node)
+    region_map = map_cache.getOrCompute(
+        (dataset, minutes_per_node, region, 'load', tuple(int(region_bounds[key]) for key in ['ymin', 'ymax', 'xmin', 'xmax'])),
+        lambda: _loadRegionMapUncached(region, region_bounds, dataset, minutes_per_node),
+    )
+    return _setImageFolder(region_map, image_folder)
+
+def _validateInput(dataset, minutes_per_node):
     assert (dataset in allowed_dataset_input), 'Dataset must be one of: ' + str(allowed_dataset_input)
     assert (minutes_per_node in allowed_minute_input), 'Number of minutes must be one of: ' + str(allowed_minute_input)
-    
+
+def _setImageFolder(map_instance, image_folder):
+    return map_instance.newChildInstance({'image_folder': image_folder}, map_instance.data)
+
+def _loadBaseMapUncached(dataset, minutes_per_node):
+    # Prefer the tiled version of the data if it has been made, it doesn't need to be decompressed
+    if _hasTiles(dataset, minutes_per_node):
+        tiles_info = _loadTilesInfo(dataset, minutes_per_node)
+        return _loadRegionMapUncached('world', {
+            'ymin': 0, 'ymax': tiles_info['n_rows'], 'xmin': 0, 'xmax': tiles_info['n_cols'],
+        }, dataset, minutes_per_node)
+
     # Load Data
     data_file = open('data/{}_world_{}min.npz'.format(dataset, minutes_per_node), 'rb')
     data_2d = np.load(data_file)
@@ -20,7 +66,7 @@ def loadBaseMap(dataset, minutes_per_node, image_folder):
     attributes = {
         'minutes_per_node': minutes_per_node,
         'dataset': dataset.lower(),
-        'image_folder': image_folder,
+        'image_folder': None,
         'region': 'world',
     }
 
@@ -28,12 +74,176 @@ def loadBaseMap(dataset, minutes_per_node, image_folder):
     [n_rows, n_cols] = data_2d.shape
     return MapInstance(attributes, n_rows, n_cols, data_2d.flatten())
 
-def loadRegionMap(region, dataset, minutes_per_node, image_folder):
-    world_map = loadBaseMap(dataset, minutes_per_node, image_folder)
-    region_bounds = _loadRegionBounds(region, minutes_per_node)
-    return world_map.newChildRegionInstance(region, region_bounds)
+def _loadRegionMapUncached(region, region_bounds, dataset, minutes_per_node):
+    if not _hasTiles(dataset, minutes_per_node):
+        # Copied out of the world map, since a view would keep the whole world alive in map_cache after it's evicted
+        region_map = loadBaseMap(dataset, minutes_per_node, None).newChildRegionInstance(region, region_bounds)
+        return region_map.newChildInstance({}, region_map.getDataFlat(copy=True))
+
+    data_2d = _loadTiledWindow(dataset, minutes_per_node, region_bounds)
+    attributes = {
+        'minutes_per_node': minutes_per_node,
+        'dataset': dataset.lower(),
+        'image_folder': None,
+        'region': region,
+    }
+    [n_rows, n_cols] = data_2d.shape
+    return MapInstance(attributes, n_rows, n_cols, data_2d.reshape(n_rows * n_cols))
+
+##
+# Converts a compressed world map (.npz) to tiles saved in an uncompressed, memory-mappable .npy file
+#
+# The tiles file has shape [n_tile_rows, n_tile_cols, tile_size, tile_size], so every tile is in one contiguous
+# block on disk and reading a region only touches the blocks it overlaps. The edges are padded with zeros.
+#
+def convertNPZToTiles(dataset, minutes_per_node, tile_size=default_tile_size, compressed=False, n_processes=None):
+    data_file = open('data/{}_world_{}min.npz'.format(dataset, minutes_per_node), 'rb')
+    data_2d = np.load(data_file)
+    if not isinstance(data_2d, np.ndarray):
+        data_2d = data_2d['data_matrix']
+    data_file.close()
+    saveTiles(data_2d, dataset, minutes_per_node, tile_size, compressed, n_processes)
+
+def saveTiles(data_2d, dataset, minutes_per_node, tile_size=default_tile_size, compressed=False, n_processes=None):
+    [n_rows, n_cols] = data_2d.shape
+    saveTileBands(
+        (data_2d[ymin:ymin + tile_size, :] for ymin in range(0, n_rows, tile_size)),
+        n_rows, n_cols, data_2d.dtype, dataset, minutes_per_node, tile_size, compressed, n_processes,
+    )
+
+##
+# Saves a map given as bands of rows, each band being one row of tiles (tile_size rows, fewer for the last one)
+#
+# compressed=True saves each band as its own compressed .npz file instead of one uncompressed .npy,
+# compressing the bands in a pool of n_processes (None for all cores). Loading a region then only decompresses
+# the bands it overlaps.
+#
+def saveTileBands(bands, n_rows, n_cols, dtype, dataset, minutes_per_node, tile_size=default_tile_size,
+                  compressed=False, n_processes=None):
+    n_tile_rows = -(-n_rows // tile_size)
+    n_tile_cols = -(-n_cols // tile_size)
+
+    tiles_folder = _getTilesFolder(dataset, minutes_per_node)
+    os.makedirs(tiles_folder, exist_ok=True)
+    if os.path.exists(tiles_folder + 'info.json'): # the tiles of an earlier conversion stop being used until these are done
+        os.remove(tiles_folder + 'info.json')
+    if compressed:
+        tasks = ((tiles_folder + 'band_{}.npz'.format(tile_row), band) for tile_row, band in enumerate(bands))
+        if n_processes == 1:
+            n_bands = len([_saveBandCompressed(task) for task in tasks])
+        else:
+            with multiprocessing.Pool(n_processes) as pool:
+                n_bands = len(list(pool.imap(_saveBandCompressed, tasks)))
+        assert (n_bands == n_tile_rows), 'Bands must cover all of the rows'
+    else:
+        tiles = np.lib.format.open_memmap(
+            tiles_folder + 'tiles.npy',
+            mode='w+',
+            dtype=dtype,
+            shape=(n_tile_rows, n_tile_cols, tile_size, tile_size),
+        )
+
+        # Copy one row of tiles at a time
+        for tile_row, data_band in enumerate(bands):
+            band = np.zeros([tile_size, n_tile_cols * tile_size], dtype=dtype)
+            band[:data_band.shape[0], :n_cols] = data_band
+            tiles[tile_row] = band.reshape([tile_size, n_tile_cols, tile_size]).transpose([1, 0, 2])
+        tiles.flush()
+        del tiles
+
+    # Write the info last, so partially written tiles are never used
+    info_file = open(tiles_folder + 'info.json', 'w')
+    json.dump({'n_rows': int(n_rows), 'n_cols': int(n_cols), 'tile_size': tile_size, 'compressed': compressed}, info_file)
+    info_file.close()
+
+def _saveBandCompressed(task):
+    filename, band = task
+    band_file = open(filename, 'wb')
+    np.savez_compressed(band_file, data_matrix=band)
+    band_file.close()
+
+##
+# Reads the world map a band of rows at a time
+#
+# From the tiles if they have been made, so only one band is in memory at a time,
+# otherwise from the .npz file (which has to be decompressed whole, but is still handed out in bands)
+#
+def iterWorldBands(dataset, minutes_per_node, n_band_rows=default_tile_size):
+    if _hasTiles(dataset, minutes_per_node):
+        tiles_info = _loadTilesInfo(dataset, minutes_per_node)
+        for ymin in range(0, tiles_info['n_rows'], n_band_rows):
+            yield _loadTiledWindow(dataset, minutes_per_node, {
+                'ymin': ymin, 'ymax': min(ymin + n_band_rows, tiles_info['n_rows']), 'xmin': 0, 'xmax': tiles_info['n_cols'],
+            })
+        return
+
+    data_file = open('data/{}_world_{}min.npz'.format(dataset, minutes_per_node), 'rb')
+    data_2d = np.load(data_file)
+    if not isinstance(data_2d, np.ndarray):
+        data_2d = data_2d['data_matrix']
+    data_file.close()
+    for ymin in range(0, data_2d.shape[0], n_band_rows):
+        yield data_2d[ymin:ymin + n_band_rows]
+
+def _getTilesFolder(dataset, minutes_per_node):
+    return 'data/{}_world_{}min.tiles/'.format(dataset, minutes_per_node)
+
+# Tiles are only used once they're finished (their info is written last), and not once the .npz has been rewritten
+# since (eg. by createCoarserResolutionFiles), so a stale or partial conversion never wins over the .npz
+def _hasTiles(dataset, minutes_per_node):
+    info_filename = _getTilesFolder(dataset, minutes_per_node) + 'info.json'
+    if not os.path.exists(info_filename):
+        return False
+    npz_filename = 'data/{}_world_{}min.npz'.format(dataset, minutes_per_node)
+    return not os.path.exists(npz_filename) or os.path.getmtime(npz_filename) <= os.path.getmtime(info_filename)
+
+def _loadTilesInfo(dataset, minutes_per_node):
+    info_file = open(_getTilesFolder(dataset, minutes_per_node) + 'info.json', 'r')
+    tiles_info = json.load(info_file)
+    info_file.close()
+    return tiles_info
+
+# Reads the window [ymin:ymax, xmin:xmax] of the map from its tiles
+def _loadTiledWindow(dataset, minutes_per_node, bounds):
+    tiles_info = _loadTilesInfo(dataset, minutes_per_node)
+    tile_size = tiles_info['tile_size']
+    ymin, ymax, xmin, xmax = [int(bounds[key]) for key in ['ymin', 'ymax', 'xmin', 'xmax']]
+    assert (0 <= ymin < ymax <= tiles_info['n_rows'] and 0 <= xmin < xmax <= tiles_info['n_cols']), \
+        'Region bounds must be inside the map: ' + str(bounds)
+
+    # Compressed tiles are saved as one file per row of tiles
+    if tiles_info.get('compressed', False):
+        window = None
+        for tile_row in range(ymin // tile_size, (ymax - 1) // tile_size + 1):
+            band_file = open(_getTilesFolder(dataset, minutes_per_node) + 'band_{}.npz'.format(tile_row), 'rb')
+            band = np.load(band_file)['data_matrix']
+            band_file.close()
+            if window is None:
+                window = np.empty([ymax - ymin, xmax - xmin], dtype=band.dtype)
+            tile_ymin = tile_row * tile_size
+            y0 = max(ymin, tile_ymin)
+            y1 = min(ymax, tile_ymin + tile_size)
+            window[y0 - ymin:y1 - ymin, :] = band[y0 - tile_ymin:y1 - tile_ymin, xmin:xmax]
+        return window
+
+    tiles = np.load(_getTilesFolder(dataset, minutes_per_node) + 'tiles.npy', mmap_mode='r')
+    window = np.empty([ymax - ymin, xmax - xmin], dtype=tiles.dtype)
+    for tile_row in range(ymin // tile_size, (ymax - 1) // tile_size + 1):
+        tile_ymin = tile_row * tile_size
+        y0 = max(ymin, tile_ymin)
+        y1 = min(ymax, tile_ymin + tile_size)
+        for tile_col in range(xmin // tile_size, (xmax - 1) // tile_size + 1):
+            tile_xmin = tile_col * tile_size
+            x0 = max(xmin, tile_xmin)
+            x1 = min(xmax, tile_xmin + tile_size)
+            window[y0 - ymin:y1 - ymin, x0 - xmin:x1 - xmin] = \
+                tiles[tile_row, tile_col, y0 - tile_ymin:y1 - tile_ymin, x0 - tile_xmin:x1 - tile_xmin]
+    return window
     
 def _loadAllRegionsBounds():
+    return map_cache.getOrCompute(('regions', None, None, 'load', ()), _loadAllRegionsBoundsUncached)
+
+def _loadAllRegionsBoundsUncached():
     data_file = open('data/region_coordinates.csv', 'rb')
     data_regions = np.loadtxt(
         data_file, 
@@ -52,7 +262,7 @@ def _loadAllRegionsBounds():
 def _loadRegionBounds(region_name, minutes_per_node=5):
     regions_bounds = _loadAllRegionsBounds()
     
-    region_bounds = regions_bounds[region_name]
+    region_bounds = regions_bounds[region_name].copy() # the cached bounds are shared
     for key in region_bounds:
         region_bounds[key] //= minutes_per_node
     return region_bounds
\ No newline at end of file
@@ -0,0 +1,72 @@
+import numpy as np
+
+##
+# DisjointSet keeps track of which group each node belongs to while groups are merged together.
+#
+# Previously, merging two groups relabeled every node with `nodes_group[nodes_group == old] = new`
+# which scans the whole map for every merge. This is a union-find forest instead: each node points
+# to a parent node in its group and the root of the tree stands for the whole group.
+# Finding the root compresses the path behind it and merging hangs the shorter tree under the taller one
+# so both operations take nearly constant time.
+#
+# Each group also carries a label (eg. the index of its peak) separately from its root,
+# so the caller decides which label survives a merge independently of how the trees are balanced.
+#
+class DisjointSet():
+    # nodes_label should point every node to the representative node of its starting group
+    # and every representative should point to itself (eg. the output of getLocalPeaks)
+    def __init__(self, nodes_label):
+        nodes_label = np.asarray(nodes_label)
+        self.nodes_parent = nodes_label.copy()
+        self.roots_label = nodes_label.copy() # only meaningful at the roots
+
+        # Representatives start with a rank of 1 since they already have the other nodes below them
+        self.nodes_rank = np.zeros(len(nodes_label), dtype=np.int8)
+        self.nodes_rank[nodes_label[nodes_label == np.arange(len(nodes_label))]] = 1
+
+    def find(self, node):
+        nodes_parent = self.nodes_parent
+        root = node
+        while nodes_parent[root] != root:
+            root = nodes_parent[root]
+
+        # Path compression, point everything we passed directly to the root
+        while nodes_parent[node] != root:
+            nodes_parent[node], node = root, nodes_parent[node]
+        return root
+
+    def getLabel(self, node):
+        return self.roots_label[self.find(node)]
+
+    def getRootLabel(self, root):
+        return self.roots_label[root]
+
+    # Merges the group of node_lo into the group of node_hi, the merged group keeps node_hi's label
+    # Returns the root of the merged group
+    def union(self, node_lo, node_hi):
+        root_lo = self.find(node_lo)
+        root_hi = self.find(node_hi)
+        if root_lo == root_hi:
+            return root_hi
+        label = self.roots_label[root_hi]
+
+        # Union by rank, hang the shallower tree under the deeper one
+        if self.nodes_rank[root_lo] > self.nodes_rank[root_hi]:
+            root_lo, root_hi = root_hi, root_lo
+        elif self.nodes_rank[root_lo] == self.nodes_rank[root_hi]:
+            self.nodes_rank[root_hi] += 1
+        self.nodes_parent[root_lo] = root_hi
+        self.roots_label[root_hi] = label
+        return root_hi
+
+    # Gets the current label of every node at once
+    def getNodesLabel(self):
+        # Pointer jumping over the whole array, then keep the compressed forest for later finds
+        nodes_root = self.nodes_parent
+        while True:
+            nodes_root_cand = nodes_root[nodes_root]
+            if np.array_equal(nodes_root_cand, nodes_root):
+                break
+            nodes_root = nodes_root_cand
+        self.nodes_parent = nodes_root.copy()
+        return self.roots_label[nodes_root]
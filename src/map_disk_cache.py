@@ -0,0 +1,165 @@
+##
+# A cache on disk of what a partition computes (highest neighbors, locales, merges), to skip recomputing them
+# when a notebook is run again, unlike map_cache which only lasts as long as the process.
+#
+# Entries are keyed by a hash of the input data and the parameters together with algorithm_version, so they're
+# never used once the data changes, and bumping the version (whenever a change to the algorithms changes their
+# output) makes every older entry unreachable. Unreachable entries are removed by the least recently used eviction
+# once the cache goes over max_bytes.
+#
+# Each entry is a folder of .npy files plus info.json describing how to put the value back together (MapInstances,
+# MergeTables and dicts of arrays). The arrays are loaded memory-mapped & read-only, so loading is almost free
+# and only the parts that are read are paged in. Entries are written to a temporary folder and renamed into place,
+# so a crash never leaves a partial entry behind.
+#
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from src.map_instance import MapInstance
+from src.map_merge_table import MergeTable
+
+algorithm_version = 2 # 2: the merge sweep visits tied values in node index order
+default_folder = 'cache/'
+default_max_bytes = 2**33
+
+class DiskCache():
+    def __init__(self, folder=default_folder, max_bytes=default_max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_evictions = 0
+
+    # Returns the stored value for the key, otherwise computes it with compute() and stores it
+    # The key is a tuple of strings, numbers and arrays (eg. the input data), see getKeyHash
+    def getOrCompute(self, key, compute):
+        entry_folder = os.path.join(self.folder, getKeyHash(key))
+        if os.path.exists(os.path.join(entry_folder, 'info.json')):
+            self.n_hits += 1
+            return self._load(entry_folder)
+
+        self.n_misses += 1
+        value = compute()
+        self._save(entry_folder, value)
+        self._evict()
+        return value
+
+    def setLimits(self, max_bytes=None):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._evict()
+        return self
+
+    def clear(self):
+        for entry_folder, _entry_info in self._getEntries():
+            shutil.rmtree(entry_folder, ignore_errors=True)
+        return self
+
+    def getStats(self):
+        entries = self._getEntries()
+        return {
+            'hits': self.n_hits,
+            'misses': self.n_misses,
+            'evictions': self.n_evictions,
+            'entries': len(entries),
+            'bytes': sum(entry_info['n_bytes'] for _entry_folder, entry_info in entries),
+        }
+
+    def _load(self, entry_folder):
+        info_filename = os.path.join(entry_folder, 'info.json')
+        info_file = open(info_filename, 'r')
+        entry_info = json.load(info_file)
+        info_file.close()
+        os.utime(info_filename) # the modified time is when the entry was last used
+        return _unflatten(entry_info['value'], lambda name: np.load(os.path.join(entry_folder, name + '.npy'), mmap_mode='r'))
+
+    def _save(self, entry_folder, value):
+        os.makedirs(self.folder, exist_ok=True)
+        folder_temp = tempfile.mkdtemp(dir=self.folder, prefix='.tmp_')
+        arrays = {}
+        entry_info = {'value': _flatten(value, arrays), 'n_bytes': 0, 'version': algorithm_version}
+        for name, array in arrays.items():
+            np.save(os.path.join(folder_temp, name + '.npy'), array)
+            entry_info['n_bytes'] += array.nbytes
+        info_file = open(os.path.join(folder_temp, 'info.json'), 'w')
+        json.dump(entry_info, info_file)
+        info_file.close()
+        try:
+            os.rename(folder_temp, entry_folder)
+        except OSError: # another process stored the same entry first
+            shutil.rmtree(folder_temp, ignore_errors=True)
+
+    # The entries as (folder, info), least recently used first
+    def _getEntries(self):
+        if not os.path.exists(self.folder):
+            return []
+        entries = []
+        for name in os.listdir(self.folder):
+            info_filename = os.path.join(self.folder, name, 'info.json')
+            if name.startswith('.') or not os.path.exists(info_filename):
+                continue
+            info_file = open(info_filename, 'r')
+            entry_info = json.load(info_file)
+            info_file.close()
+            entries.append((os.path.getmtime(info_filename), os.path.join(self.folder, name), entry_info))
+        entries.sort(key=lambda entry: entry[0])
+        return [(entry_folder, entry_info) for _time, entry_folder, entry_info in entries]
+
+    def _evict(self):
+        entries = self._getEntries()
+        n_bytes = sum(entry_info['n_bytes'] for _entry_folder, entry_info in entries)
+        for entry_folder, entry_info in entries:
+            if n_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(entry_folder, ignore_errors=True)
+            n_bytes -= entry_info['n_bytes']
+            self.n_evictions += 1
+
+# The cache used when a LocalePartition is given disk_cache=True
+default_cache = DiskCache()
+
+def getKeyHash(key):
+    key_hash = hashlib.blake2b(digest_size=20)
+    key_hash.update(str(algorithm_version).encode())
+    for part in key:
+        if isinstance(part, np.ndarray):
+            key_hash.update('array {} {}'.format(part.dtype.str, part.shape).encode())
+            key_hash.update(np.ascontiguousarray(part).data)
+        else:
+            key_hash.update(repr(part).encode())
+        key_hash.update(b'\0')
+    return key_hash.hexdigest()
+
+# Splits a value into its arrays (added to arrays by name) & a description of how to put them back together
+def _flatten(value, arrays):
+    if isinstance(value, np.ndarray):
+        name = 'array_' + str(len(arrays))
+        arrays[name] = value
+        return {'type': 'array', 'name': name}
+    if isinstance(value, MapInstance):
+        return {
+            'type': 'map',
+            'attributes': value.attributes,
+            'n_rows': int(value.n_rows),
+            'n_cols': int(value.n_cols),
+            'is_packed': value.is_packed,
+            'data': _flatten(value.data, arrays),
+        }
+    if isinstance(value, MergeTable):
+        return {'type': 'merges', 'columns': _flatten(value.columns, arrays)}
+    if isinstance(value, dict):
+        return {'type': 'dict', 'items': {key: _flatten(value[key], arrays) for key in value}}
+    assert (False), 'Only arrays, MapInstances, MergeTables & dicts of them can be stored, not ' + str(type(value))
+
+def _unflatten(description, loadArray):
+    if description['type'] == 'array':
+        return loadArray(description['name'])
+    if description['type'] == 'map':
+        return MapInstance(description['attributes'], description['n_rows'], description['n_cols'],
+                           _unflatten(description['data'], loadArray), is_packed=description['is_packed'])
+    if description['type'] == 'merges':
+        return MergeTable(_unflatten(description['columns'], loadArray))
+    return {key: _unflatten(item, loadArray) for key, item in description['items'].items()}
@@ -0,0 +1,30 @@
+import numpy as np
+
+##
+# The dtypes used for the same kinds of values across map_transforms, map_partition & MapInstance
+#
+# Node indices and everything labeled by a node (highest neighbors, locales, divisions, neighbor tables, merges)
+# are int32 whenever the map has fewer than 2^31 nodes, half the memory of numpy's default int64.
+# Small categories (eg. the landsea interfaces in map_merge_table) are uint8 codes rather than strings.
+# Masks are bool, and can be bit-packed (packMask) to an eighth of that when they're kept around but rarely read.
+#
+code_dtype = np.uint8
+mask_dtype = np.bool_
+
+# Smallest integer type that can hold every node index (and -1 for missing neighbors)
+def getNodesIndexDtype(n_nodes):
+    return np.int32 if n_nodes < 2**31 else np.int64
+
+# The index of every node, eg. np.arange(n_nodes) in the node index dtype
+def getNodesIndex(n_nodes):
+    return np.arange(n_nodes, dtype=getNodesIndexDtype(n_nodes))
+
+# Converts node indices (or labels that are node indices) to the node index dtype, without copying if they already are
+def asNodesIndex(nodes, n_nodes):
+    return np.asarray(nodes).astype(getNodesIndexDtype(n_nodes), copy=False)
+
+def packMask(nodes_mask):
+    return np.packbits(np.asarray(nodes_mask, dtype=mask_dtype))
+
+def unpackMask(packed_mask, n_nodes):
+    return np.unpackbits(packed_mask, count=n_nodes).view(mask_dtype)
@@ -1,11 +1,22 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.image as img
-from matplotlib.colors import LinearSegmentedColormap
+from matplotlib import colormaps
+from matplotlib.colors import LinearSegmentedColormap, Normalize
+from src import map_png, map_pyramid
+
+##
+# The colors are composited into one working buffer of n_nodes x 4 (RGBA) colors, float32 by default.
+# With dtype=np.uint8 the buffer holds 0-255 values and takes a quarter of the memory, at the cost of rounding
+# the colors after every layer. Layers are applied a chunk of nodes at a time, so each layer only needs
+# a chunk-sized temporary on top of the buffer.
+#
+default_dtype = np.float32
+allowed_dtypes = [np.dtype(np.float32), np.dtype(np.float64), np.dtype(np.uint8)]
+default_chunk_size = 2**20
 
 class RasterImage():
     ## baseMapInstance should contain all of the basic image of the map, eg. number of rows and cols
-    def __init__ (self, baseMapInstance, map_transforms=None, n_neighbors=None):
+    # display_enabled=False turns display() into a no-op, for batch jobs without a screen
+    def __init__ (self, baseMapInstance, map_transforms=None, n_neighbors=None, dtype=default_dtype, display_enabled=True):
         # transforms should be of type MapTransforms
         
         # Names of different aspects -- important for saving the filename
@@ -22,9 +33,14 @@ class RasterImage():
         
         # Other
         self.map_transforms = map_transforms
+        self.is_display_enabled = display_enabled
          
-        # Initialize empty data
-        self.nodes_colors = np.ones([self.n_nodes,1], dtype=float) * np.array([0, 0, 0, 1]).reshape([1,4])
+        # Initialize empty data (black & opaque)
+        self.dtype = np.dtype(dtype)
+        assert (self.dtype in allowed_dtypes), 'Image dtype must be one of: ' + str(allowed_dtypes)
+        self.chunk_size = default_chunk_size
+        self.nodes_colors = np.zeros([self.n_nodes, 4], dtype=self.dtype)
+        self.nodes_colors[:, 3] = 255 if self.dtype == np.uint8 else 1
         self.layer_names = []
         self.fig = None
         self.background = None
@@ -48,7 +64,7 @@ class RasterImage():
         if (isinstance(values, (int, float))):
             value_format = 'factor'
         else:
-            values = np.array(values)
+            values = np.asarray(values) # only read, never written to
             shape = values.shape
             n_dims = len(shape)
             if(n_dims == 1 and shape[0] <= 4):
@@ -64,10 +80,8 @@ class RasterImage():
                 
         # Nodes Colored / Mask processing
         # Mask should be either n_nodes bool array or array of nodes_index that's colored
-        n_nodes_selected = self.n_nodes
-        if (nodes_selected is None): # If not specified, change all nodes
-            nodes_selected = np.arange(self.n_nodes)
-        else:
+        n_nodes_selected = self.n_nodes # If not specified, change all nodes
+        if (nodes_selected is not None):
             if(nodes_selected.dtype is np.dtype('bool')):
                 n_nodes_selected = np.count_nonzero(nodes_selected)
             else:
@@ -84,54 +98,105 @@ class RasterImage():
             values = self.map_transforms.getNodesBorder(values)
         if ('prandom' in transforms):
             values = values * 1619 % 251
+        normalize = None
         if ('norm' in transforms): # puts them in range 0 to 1
-            values = plt.Normalize()(values)
+            normalize = Normalize()
+            normalize.autoscale_None(values)
+        colorize = None
         if (colormap is not None): # Apply Color
             assert (value_format == 'nodes_factor')
             
             if (colormap == 'prism'):
-                values = plt.cm.prism(values)
+                colorize = colormaps['prism']
             elif (colormap == 'diverge'): # diverge
-                values = plt.cm.RdYlBu(values)
+                colorize = colormaps['RdYlBu']
             elif (colormap == 'qual'): # qualitiative
-                values = plt.cm.Paired(values)
+                colorize = colormaps['Paired']
             elif (colormap == 'naturalish'):
-                values = _applyNaturalishColormap(values)
+                # The colormap is scaled by the extremes of all of the values, not just the chunk
+                values_normed = normalize(values) if normalize is not None else values
+                land_max = max(np.max(values_normed), 0)
+                sea_max = max(-np.min(values_normed), 0)
+                colorize = lambda chunk_values: _applyNaturalishColormap(chunk_values, land_max=land_max, sea_max=sea_max)
             elif (colormap == 'hashed'):
-                values = _applyHashedColormap(values)
+                colorize = _applyHashedColormap
             else: # rainbow
-                values = plt.cm.rainbow(values)
+                colorize = colormaps['rainbow']
             value_format = 'nodes_color'
             n_color_channels = 4
-            
-        # Expand the values to full color (nodes x channels) or keep as single number
-        if (value_format == 'color'):
-            values = values.reshape([1, n_color_channels]).repeat(n_nodes_selected, axis=0)
-        elif (value_format == 'nodes_factor' and color_channel is None):
-            values = values.reshape([n_nodes_selected, 1]).repeat(n_color_channels, axis=1)
-        else: # factor (returns 1) or nodes_color returns (n_nodes_colored x n_color_channels)
-            values = values
-        
-        # Apply to pixel colors
-        if (color_channel is not None): # 0 to 3: red, green, blue, opacity
-            self.nodes_colors[nodes_selected, color_channel] = values
-        elif (combine == 'set'): # value doesn't matter
-            self.nodes_colors[nodes_selected, :n_color_channels] = values
-        elif (combine == 'add'): # factor [0-1] used in formula original * (1 - value) + new * value
-            #self.nodes_colors = self.nodes_colors * (1 - factor) + data * factor
-            opacity = opacity if opacity is not None else 0.5 # make custom
-            dissolve = dissolve if dissolve is not None else 1 - opacity
-            self.nodes_colors[nodes_selected, :n_color_channels] *= dissolve
-            self.nodes_colors[nodes_selected, :n_color_channels] += values * opacity
-        elif (combine == 'multiply'):
-            self.nodes_colors[nodes_selected, :n_color_channels] *= values
-        else:
+
+        # Colors & node factors are broadcast over the nodes rather than being repeated for each one
+        def getChunkValues(chunk):
+            if (value_format not in ['nodes_factor', 'nodes_color']):
+                return values
+            chunk_values = values[chunk]
+            if (normalize is not None):
+                chunk_values = normalize(chunk_values)
+            if (colorize is not None):
+                chunk_values = colorize(chunk_values)
+            elif (value_format == 'nodes_factor' and color_channel is None):
+                chunk_values = chunk_values.reshape([-1, 1])
+            return chunk_values
+
+        if (color_channel is None and combine not in ['set', 'add', 'multiply']):
             raise Exception('Invalid way to combine, must set color_channel [0-3] or set combine [set, add, multiply]')
-            
-        # Ensures no node is too big or too small
-        self.nodes_colors = np.fmax(np.fmin(self.nodes_colors, 1), 0)
+        opacity = opacity if opacity is not None else 0.5 # make custom
+        dissolve = dissolve if dissolve is not None else 1 - opacity
+        channels = color_channel if color_channel is not None else slice(0, n_color_channels)
+
+        # Apply to pixel colors, a chunk of the selected nodes at a time
+        nodes_index = None if nodes_selected is None else \
+            np.flatnonzero(nodes_selected) if nodes_selected.dtype == np.dtype('bool') else nodes_selected
+        for start in range(0, n_nodes_selected, self.chunk_size):
+            chunk = slice(start, min(start + self.chunk_size, n_nodes_selected))
+            nodes_chunk = chunk if nodes_index is None else nodes_index[chunk]
+            chunk_values = getChunkValues(chunk)
+
+            # Float buffers are worked on in place when the nodes are a slice, otherwise a copy is taken & written back
+            colors = self.nodes_colors[nodes_chunk, channels]
+            if (self.dtype == np.uint8):
+                colors = colors.astype(np.float32) / 255
+
+            if (color_channel is not None): # 0 to 3: red, green, blue, opacity
+                colors[...] = chunk_values
+            elif (combine == 'set'): # value doesn't matter
+                colors[...] = chunk_values
+            elif (combine == 'add'): # factor [0-1] used in formula original * (1 - value) + new * value
+                colors *= dissolve
+                colors += chunk_values * opacity
+            elif (combine == 'multiply'):
+                colors *= chunk_values
+
+            # Ensures no node is too big or too small
+            np.fmin(colors, 1, out=colors)
+            np.fmax(colors, 0, out=colors)
+
+            if (self.dtype == np.uint8):
+                self.nodes_colors[nodes_chunk, channels] = np.rint(colors * 255)
+            elif (not isinstance(nodes_chunk, slice)):
+                self.nodes_colors[nodes_chunk, channels] = colors
         return self
     
+    # Applies a stack of layers combined ahead of time with getLayerStack, in one pass over the colors
+    def addLayerStack(self, layer_stack):
+        for name in layer_stack['names']:
+            self.addToFilename(name)
+
+        for start in range(0, self.n_nodes, self.chunk_size):
+            chunk = slice(start, min(start + self.chunk_size, self.n_nodes))
+            colors = self.nodes_colors[chunk, :3]
+            if (self.dtype == np.uint8):
+                colors = colors.astype(np.float32) / 255
+
+            colors *= layer_stack['scale'][chunk].reshape([-1, 1])
+            colors += layer_stack['offset'][chunk].reshape([-1, 1])
+            np.fmax(colors, layer_stack['lo'][chunk].reshape([-1, 1]), out=colors)
+            np.fmin(colors, layer_stack['hi'][chunk].reshape([-1, 1]), out=colors)
+
+            if (self.dtype == np.uint8):
+                self.nodes_colors[chunk, :3] = np.rint(colors * 255)
+        return self
+
     def addToFilename(self, name=''):
         if(name is not None and name != ''):
             self.layer_names.append(name)
@@ -153,14 +218,42 @@ class RasterImage():
         self.filename = self.folder + filename
         return filename
     
+    # Images are written a band of rows at a time, quantized to uint8 (see map_png)
     def save(self, save_fig = False):
         filename = self.getFilename()
-        img.imsave(self.filename, self.nodes_colors.reshape([self.n_rows, self.n_cols, 4]))
+        gridded_colors = self.nodes_colors.reshape([self.n_rows, self.n_cols, 4])
+        map_png.savePNG(self.filename, self.n_rows, self.n_cols, 4, (
+            map_png.getColorsUint8(gridded_colors[ymin:ymin + map_png.default_band_size])
+            for ymin in range(0, self.n_rows, map_png.default_band_size)
+        ))
         if(save_fig and self.fig is not None):
             self.fig.savefig(self.folder + 'fig_' + filename, bbox_inches='tight')
         return self
         
+    # Saves the image as a pyramid of tiles in a folder named after the image (see map_pyramid)
+    # Tiles where every node is in nodes_skip (eg. the sea map) aren't saved
+    def savePyramid(self, nodes_skip=None, tile_size=map_pyramid.default_tile_size, n_processes=None):
+        filename = self.getFilename()
+        gridded_colors = self.nodes_colors.reshape([self.n_rows, self.n_cols, 4])
+        bands_ymin = range(0, self.n_rows, tile_size)
+        self.pyramid_summary = map_pyramid.savePyramid(
+            self.folder + filename[:-len('.png')] + '_tiles/',
+            self.n_rows,
+            self.n_cols,
+            (map_png.getColorsUint8(gridded_colors[ymin:ymin + tile_size]) for ymin in bands_ymin),
+            None if nodes_skip is None else
+                (nodes_skip.reshape([self.n_rows, self.n_cols])[ymin:ymin + tile_size] for ymin in bands_ymin),
+            tile_size=tile_size,
+            n_processes=n_processes,
+        )
+        return self
+
     def display(self):
+        if not self.is_display_enabled:
+            return self
+
+        # pyplot is only needed to show the image, so saving images doesn't import it
+        import matplotlib.pyplot as plt
         self.fig = plt.figure(figsize=(12,8))
         plt.imshow(self.nodes_colors.reshape([self.n_rows, self.n_cols, 4]))
         plt.show()
@@ -172,13 +265,59 @@ class RasterImage():
         # So output of self doesn't appear if you don't want it
         return
     
+##
+# Combines a stack of layers that are redrawn on top of many images (eg. sea, hillshade & coast) ahead of time
+#
+# layers are dicts of addLayer's arguments, limited to combining single values or node factors with
+# 'set', 'add' or 'multiply' on the color channels. Each of these maps a color to clip(color * a + b, 0, 1) with a >= 0,
+# and any number of them one after the other is still a clipped line: clip(color * scale + offset, lo, hi)
+# So the whole stack comes down to 4 values per node, and applying it (addLayerStack) is a single pass
+# instead of one pass per layer.
+#
+def getLayerStack(n_nodes, layers):
+    layer_stack = {
+        'names': [],
+        'scale': np.ones(n_nodes, dtype=np.float32),
+        'offset': np.zeros(n_nodes, dtype=np.float32),
+        'lo': np.zeros(n_nodes, dtype=np.float32),
+        'hi': np.ones(n_nodes, dtype=np.float32),
+    }
+    for layer in layers:
+        layer_stack['names'].append(layer['name'])
+        values = np.asarray(layer['values'])
+        nodes_selected = layer.get('nodes_selected')
+        nodes_index = slice(None) if nodes_selected is None else \
+            np.flatnonzero(nodes_selected) if nodes_selected.dtype == np.dtype('bool') else nodes_selected
+        if (values.ndim == 1 and len(values) == n_nodes and nodes_selected is not None):
+            values = values[nodes_index]
+
+        combine = layer.get('combine', 'set')
+        if (combine == 'set'):
+            a, b = 0, values
+        elif (combine == 'add'):
+            opacity = layer.get('opacity') if layer.get('opacity') is not None else 0.5
+            dissolve = layer.get('dissolve') if layer.get('dissolve') is not None else 1 - opacity
+            a, b = dissolve, values * opacity
+        elif (combine == 'multiply'):
+            a, b = values, 0
+        else:
+            raise Exception('Invalid way to combine, must set combine [set, add, multiply]')
+        assert (np.all(np.asarray(a) >= 0)), 'Layers in a stack can only scale colors by positive factors'
+
+        layer_stack['scale'][nodes_index] *= a
+        layer_stack['offset'][nodes_index] = layer_stack['offset'][nodes_index] * a + b
+        for bound in ['lo', 'hi']:
+            layer_stack[bound][nodes_index] = np.clip(layer_stack[bound][nodes_index] * a + b, 0, 1)
+    return layer_stack
+
 # Get natural coloring
 land_colors = ['beige', 'yellowgreen', 'forestgreen', 'darkolivegreen', 'slategrey', 'snow']
 sea_colors = ['deepskyblue', 'mediumblue', 'darkblue']
 colormap_land = LinearSegmentedColormap.from_list("colormap_land", land_colors)
 colormap_sea = LinearSegmentedColormap.from_list("colormap_sea", sea_colors)
 
-def _applyNaturalishColormap(data_flat, normalize=True):
+# land_max & sea_max can be given to scale the colors by the values of the whole map when only coloring part of it
+def _applyNaturalishColormap(data_flat, normalize=True, land_max=None, sea_max=None):
     # First lets divide the data into land and sea
     land = data_flat.astype(float) # makes sure it is float typed, & makes a new copy of the matrix
     sea = -data_flat.astype(float) # makes sure it is float typed, & makes a new copy of the matrix
@@ -187,8 +326,8 @@ def _applyNaturalishColormap(data_flat, normalize=True):
     
     # Divide by the maximum if we want to normalize it
     if(normalize):
-        land /= np.max(land)
-        sea /= np.max(sea)
+        land /= land_max if land_max is not None else np.max(land)
+        sea /= sea_max if sea_max is not None else np.max(sea)
     
     # Apply the colors. This should give us an n*4 matrix
     land = colormap_land(land)
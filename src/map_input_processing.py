@@ -3,7 +3,12 @@
 #
 
 import numpy as np
-from src import map_instance, map_image, map_transforms, map_data
+from src import map_instance, map_image, map_transforms, map_data, map_algebra
+
+# How the nodes of a finer map are combined into each node of a coarser one
+# Population is summed so the totals stay the same, elevations are averaged ('max' keeps the peaks instead)
+allowed_reductions = ['mean', 'max', 'sum']
+default_reductions = {'POP': 'sum', 'TBI': 'mean', 'BED': 'mean', 'ICE': 'mean', 'RET': 'mean', 'SUR': 'mean'}
 
 def drawBasicValueMap(
     map_elevation, # type map_instance
@@ -33,7 +38,8 @@ def processBinaryDataFileToNPZ(
     input_folder,
     image_folder, # eg. img/##/
     dataset = 'TBI', # The original data from https://ddfe.curtin.edu.au/models/ has forms BED, ICE, RET, SUR, and TBI
-    minutes_per_node = 1, # only 1 and 5 minutes available to download -- other data will have to be computed
+    minutes_per_node = 1, # only 1 and 5 minutes available to download -- use createCoarserResolutionFiles for the others
+    draw_preview = True,
 ):
     # Load the file
     filename='{}/Earth2014.{}2014.{}min.geod.bin'.format(input_folder, dataset, minutes_per_node)
@@ -46,16 +52,17 @@ def processBinaryDataFileToNPZ(
     input_file.close()
 
     # Build a map instance and generate an image
-    input_map = map_instance.MapInstance({
-        'minutes_per_node': minutes_per_node,
-        'dataset': dataset.lower(),
-        'image_folder': image_folder,
-        'region': 'world',
-    }, 
-        180 * 60 // minutes_per_node, # n_rows
-        360 * 60 // minutes_per_node, # n_cols 
-        input_matrix.flatten())
-    drawBasicValueMap(input_map)
+    if draw_preview:
+        input_map = map_instance.MapInstance({
+            'minutes_per_node': minutes_per_node,
+            'dataset': dataset.lower(),
+            'image_folder': image_folder,
+            'region': 'world',
+        }, 
+            180 * 60 // minutes_per_node, # n_rows
+            360 * 60 // minutes_per_node, # n_cols 
+            input_matrix.flatten())
+        drawBasicValueMap(input_map)
 
     # Save the data to a compressed file
     output_file = open('data/{}_world_{}min.npz'.format(dataset, minutes_per_node), 'wb')
@@ -63,6 +70,63 @@ def processBinaryDataFileToNPZ(
     output_file.close()
 
 
+##
+# Streaming version of processBinaryDataFileToNPZ for the large (1 minute) files
+#
+# The binary file is memory-mapped rather than read, and it is byteswapped & flipped one row of tiles at a time
+# straight into the tiled format (see map_data.saveTileBands), compressed in a pool of n_processes by default.
+# The preview image is optional and drawn from a coarser version of the map (preview_minutes_per_node)
+# built along the way, rather than from the full map.
+#
+def processBinaryDataFileToTiles(
+    input_folder,
+    image_folder = None, # eg. img/##/, None to skip the preview image
+    dataset = 'TBI', # The original data from https://ddfe.curtin.edu.au/models/ has forms BED, ICE, RET, SUR, and TBI
+    minutes_per_node = 1, # only 1 and 5 minutes available to download
+    tile_size = map_data.default_tile_size,
+    compressed = True,
+    n_processes = None,
+    preview_minutes_per_node = 10,
+):
+    n_rows = 180 * 60 // minutes_per_node
+    n_cols = 360 * 60 // minutes_per_node
+    filename = '{}/Earth2014.{}2014.{}min.geod.bin'.format(input_folder, dataset, minutes_per_node)
+    input_matrix = np.memmap(filename, dtype='>i2', mode='r', shape=(n_rows, n_cols)) # int16 but big-endian (ieee-be)
+
+    # The preview is built from bands of the same rows as they go by
+    assert (preview_minutes_per_node % minutes_per_node == 0), 'Preview resolution must be a multiple of the data resolution'
+    preview_factor = preview_minutes_per_node // minutes_per_node
+    preview_reduction = default_reductions.get(dataset, 'mean')
+    preview_bands = []
+    preview_pending = [np.zeros([0, n_cols], dtype=np.int16)]
+
+    # The file starts at the south pole, so the map's first rows are read from the end of the file
+    def iterBands():
+        for ymin in range(0, n_rows, tile_size):
+            ymax = min(ymin + tile_size, n_rows)
+            band = input_matrix[n_rows - ymax:n_rows - ymin][::-1].astype(np.int16)
+            if image_folder is not None:
+                band_pending = np.concatenate([preview_pending[0], band])
+                n_rows_ready = len(band_pending) // preview_factor * preview_factor
+                preview_bands.append(_getBlockReduced(band_pending[:n_rows_ready], preview_factor, preview_reduction))
+                preview_pending[0] = band_pending[n_rows_ready:]
+            yield band
+
+    map_data.saveTileBands(iterBands(), n_rows, n_cols, np.int16, dataset, minutes_per_node, tile_size,
+                           compressed=compressed, n_processes=n_processes)
+    del input_matrix
+
+    if image_folder is not None:
+        data_preview = np.concatenate(preview_bands)
+        [n_preview_rows, n_preview_cols] = data_preview.shape
+        drawBasicValueMap(map_instance.MapInstance({
+            'minutes_per_node': preview_minutes_per_node,
+            'dataset': dataset.lower(),
+            'image_folder': image_folder,
+            'region': 'world',
+        }, n_preview_rows, n_preview_cols, data_preview.reshape(n_preview_rows * n_preview_cols)))
+
+
 def visualizeNewRegion( 
     # Give the region a name
     # Due to rigidity of the CSV file import it has to be no more than 10 characters long
@@ -99,55 +163,159 @@ def visualizeNewRegion(
 
     # Generate preview images
     if image_folder is not None:
-        map_elevation = map_data.loadBaseMap('PSL', 1, image_folder)
-        map_elevation = map_elevation.newChildRegionInstance(region_name, region_bounds)
+        map_elevation = map_data.loadRegionMapFromBounds(region_name, region_bounds, 'PSL', 1, image_folder)
         drawBasicValueMap(map_elevation)
 
-        map_elevation = map_data.loadBaseMap('TBI', 1, image_folder)
-        map_elevation = map_elevation.newChildRegionInstance(region_name, region_bounds)
+        map_elevation = map_data.loadRegionMapFromBounds(region_name, region_bounds, 'TBI', 1, image_folder)
         drawBasicValueMap(map_elevation)
         
 def createPopulationAndSeaLevelMap(
-    image_folder, # eg. img/##/
+    image_folder, # eg. img/##/, or None to skip drawing the map
     minutes_per_node = 1,
     dataset_elevation = 'TBI',
     dataset_population = 'POP',
     dataset_output = 'PSL',  # can use off-versions like PSL2 trying a different algorithim
+    formula = None, # defaults to getPopulationAndSeaLevel, see map_algebra for how to write another one
+    tiled = False, # streams the output into tiles (see map_data.saveTileBands) instead of one .npz file
+    preview_minutes_per_node = 10, # when tiled, the map is drawn from a coarser version of it read back a band at a time
 ):
     region = 'world' # Generally its recommended to do this for the whole world at once rather than per-region
-    
-    # Load the 2 input data maps to be combined
-    data_file = open('data/{}_world_{}min.npz'.format(dataset_population.lower(), minutes_per_node), 'rb')
-    data_population = np.load(data_file)
-    if not isinstance(data_population, np.ndarray):
-        data_population = data_population['data_matrix']
-    data_file.close()
-    data_file = open('data/{}_world_{}min.npz'.format(dataset_elevation.lower(), minutes_per_node), 'rb')
-    data_elevation = np.load(data_file)
-    if not isinstance(data_elevation, np.ndarray):
-        data_elevation = data_elevation['data_matrix']
-    data_file.close()
-
-    # Combine the data
-    data_2d = data_population
-    # Add negative gradient based on elevation from coast
-    data_2d[data_population <= 0] = -np.abs(data_elevation)[data_population <= 0]
-    # Add subtle positive gradient to distinguish areas with uniform population values
-    data_2d[data_population > 0] = data_2d[data_population > 0] + 1/(0.01+np.abs(data_elevation)[data_population > 0])
-
-    # Save compressed output files
-    if region == 'world':
-        data_file = open('data/{}_world_{}min.npz'.format(dataset_output, minutes_per_node), 'wb')
-        np.savez_compressed(data_file, data_matrix=data_2d)
-        data_file.close()
+    if formula is None:
+        formula = getPopulationAndSeaLevel
+
+    # Combine the 2 input data maps a block at a time
+    inputs = {'population': dataset_population, 'elevation': dataset_elevation}
+    if tiled:
+        map_algebra.saveFormulaTiles(formula, inputs, dataset_output, minutes_per_node)
+        if image_folder is None:
+            return
+        # Read back from the tiles a band at a time (loadBaseMap only loads the standard datasets) into a coarser map
+        minutes_per_node_image = max(preview_minutes_per_node, minutes_per_node)
+        preview_factor = minutes_per_node_image // minutes_per_node
+        n_band_rows = preview_factor * -(-map_data.default_tile_size // preview_factor)
+        data_2d = getCoarserResolutions(
+            map_data.iterWorldBands(dataset_output, minutes_per_node, n_band_rows),
+            minutes_per_node,
+            [minutes_per_node_image],
+            default_reductions.get(dataset_output, 'mean'),
+        )[minutes_per_node_image]
+    else:
+        data_2d = map_algebra.getFormulaWorld(formula, inputs, minutes_per_node)
+        minutes_per_node_image = minutes_per_node
+
+        # Save compressed output files
+        if region == 'world':
+            data_file = open('data/{}_world_{}min.npz'.format(dataset_output, minutes_per_node), 'wb')
+            np.savez_compressed(data_file, data_matrix=data_2d)
+            data_file.close()
 
     # Make diagrams of the data
+    if image_folder is None:
+        return
     [n_rows, n_cols] = data_2d.shape
     elevation_map = map_instance.MapInstance({
-        'minutes_per_node': minutes_per_node,
+        'minutes_per_node': minutes_per_node_image,
         'dataset': dataset_output.lower(),
         'image_folder': image_folder,
         'region': region,
-    }, n_rows, n_cols, data_2d.flatten())
+    }, n_rows, n_cols, data_2d.reshape(n_rows * n_cols))
     
-    drawBasicValueMap(elevation_map)
\ No newline at end of file
+    drawBasicValueMap(elevation_map)
+
+# The PSL formula
+def getPopulationAndSeaLevel(population, elevation):
+    elevation_abs = np.abs(elevation)
+    # Add negative gradient based on elevation from coast where there's no population,
+    # and a subtle positive gradient to distinguish areas with uniform population values
+    return np.where(population <= 0, -elevation_abs, population + 1/(0.01+elevation_abs))
+
+
+##
+# Makes the coarser resolution files of a dataset (eg. 5, 10 & 60 minutes from the 1 minute data) in one pass
+#
+# The source is read a band of rows at a time (see map_data.iterWorldBands) and every coarser map is built from it
+# at once, each from the finest map already built that it evenly divides (eg. 10 from 5 and 60 from 10 minutes).
+# Only the coarse maps & one band are in memory, never the whole source map unless it only exists as a .npz.
+#
+def createCoarserResolutionFiles(
+    dataset = 'TBI',
+    minutes_per_node = 1, # the resolution of the source data
+    minutes_per_node_targets = None, # defaults to all of the coarser resolutions in map_data.allowed_minute_input
+    reduction = None, # one of allowed_reductions, defaults to the one for the dataset in default_reductions
+    image_folder = None, # eg. img/##/, to draw each new map
+):
+    if minutes_per_node_targets is None:
+        minutes_per_node_targets = [minutes for minutes in map_data.allowed_minute_input
+                                    if minutes > minutes_per_node and minutes % minutes_per_node == 0]
+    if reduction is None:
+        assert (dataset in default_reductions), 'No default reduction for ' + dataset + ', it must be given'
+        reduction = default_reductions[dataset]
+
+    # Each band should hold whole rows of every coarser map
+    n_band_rows = np.lcm.reduce([minutes // minutes_per_node for minutes in minutes_per_node_targets])
+    n_band_rows *= -(-map_data.default_tile_size // n_band_rows)
+    maps_data_2d = getCoarserResolutions(
+        map_data.iterWorldBands(dataset, minutes_per_node, n_band_rows),
+        minutes_per_node,
+        minutes_per_node_targets,
+        reduction,
+    )
+
+    for minutes, data_2d in maps_data_2d.items():
+        output_file = open('data/{}_world_{}min.npz'.format(dataset, minutes), 'wb')
+        np.savez_compressed(output_file, data_matrix=data_2d)
+        output_file.close()
+
+        if image_folder is not None:
+            [n_rows, n_cols] = data_2d.shape
+            drawBasicValueMap(map_instance.MapInstance({
+                'minutes_per_node': minutes,
+                'dataset': dataset.lower(),
+                'image_folder': image_folder,
+                'region': 'world',
+            }, n_rows, n_cols, data_2d.reshape(n_rows * n_cols)))
+
+    return maps_data_2d
+
+# Builds the coarser maps from bands of rows of the source map, returns {minutes_per_node: data_2d}
+def getCoarserResolutions(bands, minutes_per_node, minutes_per_node_targets, reduction):
+    assert (reduction in allowed_reductions), 'Reduction must be one of: ' + str(allowed_reductions)
+    minutes_per_node_targets = sorted(minutes_per_node_targets)
+
+    # Build each map from the finest one it evenly divides
+    targets_source = {}
+    for i_target, minutes in enumerate(minutes_per_node_targets):
+        assert (minutes % minutes_per_node == 0), 'Resolutions must be multiples of the source resolution'
+        targets_source[minutes] = max([minutes_per_node] + [
+            minutes_finer for minutes_finer in minutes_per_node_targets[:i_target] if minutes % minutes_finer == 0
+        ])
+    n_block_rows = np.lcm.reduce([minutes // minutes_per_node for minutes in minutes_per_node_targets])
+
+    targets_bands = {minutes: [] for minutes in minutes_per_node_targets}
+    band_pending = None
+    for band in bands:
+        band_pending = band if band_pending is None else np.concatenate([band_pending, band])
+        n_rows_ready = len(band_pending) // n_block_rows * n_block_rows
+        if n_rows_ready == 0:
+            continue
+
+        bands_reduced = {minutes_per_node: band_pending[:n_rows_ready]}
+        for minutes in minutes_per_node_targets:
+            source = targets_source[minutes]
+            bands_reduced[minutes] = _getBlockReduced(bands_reduced[source], minutes // source, reduction)
+            targets_bands[minutes].append(bands_reduced[minutes])
+        band_pending = band_pending[n_rows_ready:]
+
+    assert (band_pending is not None and len(band_pending) == 0), 'Number of rows must divide into the coarser resolutions'
+    return {minutes: np.concatenate(targets_bands[minutes]) for minutes in minutes_per_node_targets}
+
+# Combines each factor x factor block of nodes into one node
+def _getBlockReduced(data_2d, factor, reduction):
+    [n_rows, n_cols] = data_2d.shape
+    assert (n_rows % factor == 0 and n_cols % factor == 0), 'Map dimensions must divide into the coarser resolution'
+    blocks = data_2d.reshape([n_rows // factor, factor, n_cols // factor, factor])
+    if reduction == 'mean':
+        return blocks.mean(axis=(1, 3), dtype=float)
+    if reduction == 'sum':
+        return blocks.sum(axis=(1, 3), dtype=float)
+    return blocks.max(axis=(1, 3)).astype(float)
@@ -1,11 +1,22 @@
+import numpy as np
+from src import map_dtypes
+
 ##
 # MapInstance helps organize the information that's shown in a map.
 #
 # Previously, it was hard to keep track of data, was it 1d or 2d? What were the dimensions? etc...
 # This organizes that information and makes it easy to spin off new instances of data.
 #
+# The data is shared rather than copied: getDataFlat & getDataMatrix return read-only views, so reading a map
+# doesn't allocate anything, and callers that want to change the values ask for their own copy (copy=True).
+# Region instances are strided views into their parent's data, which are only made contiguous (copied once)
+# the first time they're needed flat.
+#
+# Bool maps (eg. the sea & coast) can also be kept bit-packed (newPackedInstance), in an eighth of the memory,
+# for maps that are kept around (eg. in map_cache) but rarely read. They're unpacked every time they're read.
+#
 class MapInstance():
-    def __init__(self, attributes={}, n_rows=None, n_cols=None, data=None):
+    def __init__(self, attributes={}, n_rows=None, n_cols=None, data=None, is_packed=False):
         # Enforce required attributes
         for key in ['dataset', 'region', 'minutes_per_node', 'image_folder']:
             attributes[key] is not None
@@ -19,14 +30,15 @@ class MapInstance():
         self.n_nodes = self.n_rows * self.n_cols
         
         # Set the attributes and data if provided
+        self.is_packed = is_packed
         self.attributes = {}
         self.addToAttributes(attributes)
         self.setData(data)
         
     def setData(self, data):
-        if(len(data.shape) > 1):
-            # Make all data 1D in storage to keep it standard
-            data = data.flatten()
+        if(len(data.shape) > 1 and data.flags.c_contiguous):
+            # Make all data 1D in storage to keep it standard, unless it's a strided view of a region
+            data = data.reshape(-1)
         self.data = data
         return self
     
@@ -46,13 +58,25 @@ class MapInstance():
     def getNumNodes(self):
         return self.n_nodes
     
-    # Gets the 1D version of the data
-    def getDataFlat(self):
-        return self.data.copy()
+    # Gets the 1D version of the data, as a read-only view unless a copy to change is asked for
+    def getDataFlat(self, copy=False):
+        if self.is_packed:
+            data_flat = map_dtypes.unpackMask(self.data, self.n_nodes)
+            return data_flat if copy else _getReadOnly(data_flat)
+        if copy:
+            return self.data.flatten()
+        if len(self.data.shape) > 1:
+            is_writeable = self.data.flags.writeable
+            self.data = np.ascontiguousarray(self.data).reshape(-1)
+            self.data.flags.writeable = is_writeable
+        return _getReadOnly(self.data)
     
-    # Gets the 2D version of the data
-    def getDataMatrix(self):
-        return self.data.reshape([self.n_rows, self.n_cols])
+    # Gets the 2D version of the data, as a read-only view unless a copy to change is asked for
+    def getDataMatrix(self, copy=False):
+        if self.is_packed:
+            return self.getDataFlat(copy).reshape([self.n_rows, self.n_cols])
+        data_matrix = self.data.reshape([self.n_rows, self.n_cols])
+        return data_matrix.copy() if copy else _getReadOnly(data_matrix)
     
     def getDims(self):
         return [self.n_rows, self.n_cols]
@@ -62,13 +86,23 @@ class MapInstance():
         attributes = _mergeAttributes(self.attributes, new_attributes)
         return MapInstance(attributes, self.n_rows, self.n_cols, new_data)
     
-    # Copies the old data, zoomed in on a smaller section
+    # Copies a bool map into one that keeps its data bit-packed
+    def newPackedInstance(self):
+        assert (self.data.dtype == map_dtypes.mask_dtype), 'Only bool maps can be packed'
+        return MapInstance(self.attributes, self.n_rows, self.n_cols, map_dtypes.packMask(self.getDataFlat()), is_packed=True)
+    
+    # Views the old data, zoomed in on a smaller section
     # @param bounds should be in the same resolution as the data
     def newChildRegionInstance(self, region_name, bounds):
         new_data = self.getDataMatrix()[bounds['ymin']:bounds['ymax'],bounds['xmin']:bounds['xmax']]
         attributes = _mergeAttributes(self.attributes, {'region': region_name})
         return MapInstance(attributes, bounds['ymax']-bounds['ymin'], bounds['xmax']-bounds['xmin'], new_data)
         
+def _getReadOnly(data):
+    data_view = data.view()
+    data_view.flags.writeable = False
+    return data_view
+
 def _mergeAttributes(old_attributes, new_attributes):
     attributes = old_attributes.copy()
     for key in new_attributes:
@@ -0,0 +1,77 @@
+import numpy as np
+from src import map_transforms, map_disjoint_set
+
+##
+# LocaleGraph is the graph of which locales were merged together in LocalePartition.computeDivisionMergePoints
+# (one edge per merge, between its locale_lo & locale_hi).
+#
+# Previously this was a dict of numpy arrays, one per locale, grown with np.append for every merge.
+# Instead it is kept in compressed sparse row (CSR) form over the locales: the edges of the i-th locale are
+# edges_neighbor[offsets[i]:offsets[i+1]], in the order of the merges.
+#
+# Locales are referred to by their extremum's node index, same as everywhere else.
+# Edges are referred to by the index of their merge, and can be removed (eg. merges split across sea level)
+# without rebuilding the graph.
+#
+class LocaleGraph():
+    def __init__(self, locales, edges_lo, edges_hi):
+        self.locales = np.asarray(locales) # sorted, as given by getLocales
+        self.n_locales = len(self.locales)
+        self.n_edges = len(edges_lo)
+        self.edges_is_removed = np.zeros(self.n_edges, dtype=bool)
+
+        self.edges_lo = self.getLocalePosition(edges_lo)
+        self.edges_hi = self.getLocalePosition(edges_hi)
+
+        # Each edge goes both ways, interleaved so each locale's edges stay in merge order
+        edges_from = np.stack([self.edges_lo, self.edges_hi], axis=1).reshape(-1)
+        edges_to = np.stack([self.edges_hi, self.edges_lo], axis=1).reshape(-1)
+        edges_id = np.repeat(np.arange(self.n_edges), 2)
+        self.offsets, self.edges_neighbor = map_transforms.getCompressedAdjacency(edges_from, edges_to, self.n_locales)
+        _offsets, self.edges_neighbor_id = map_transforms.getCompressedAdjacency(edges_from, edges_id, self.n_locales)
+
+    @classmethod
+    def fromMerges(cls, locales, merges):
+        return cls(locales, merges['locale_lo'], merges['locale_hi'])
+
+    def getNumLocales(self):
+        return self.n_locales
+
+    def getNumEdges(self):
+        return self.n_edges
+
+    # Converts locales (node indices) to their position in the graph's arrays
+    def getLocalePosition(self, locales):
+        return np.searchsorted(self.locales, locales)
+
+    # Removes the edges selected by a boolean mask or an array of edge (merge) indices
+    def removeEdges(self, edges_selected):
+        self.edges_is_removed[edges_selected] = True
+        return self
+
+    def restoreEdges(self):
+        self.edges_is_removed[:] = False
+        return self
+
+    # The locales connected to the locale by an edge that hasn't been removed
+    def getNeighbors(self, locale):
+        position = self.getLocalePosition(locale)
+        start, end = self.offsets[position], self.offsets[position + 1]
+        neighbors = self.edges_neighbor[start:end][~self.edges_is_removed[self.edges_neighbor_id[start:end]]]
+        return self.locales[neighbors]
+
+    def getDegrees(self):
+        edges_from = np.repeat(np.arange(self.n_locales), np.diff(self.offsets))
+        return np.bincount(edges_from[~self.edges_is_removed[self.edges_neighbor_id]], minlength=self.n_locales)
+
+    # Number of locales with each number of connections (index 0 is the locales with none)
+    def getDegreeHistogram(self):
+        return np.bincount(self.getDegrees())
+
+    # Labels each locale with the locale representing its connected component
+    def getComponents(self):
+        components = map_disjoint_set.DisjointSet(np.arange(self.n_locales))
+        edges_kept = ~self.edges_is_removed
+        for position_lo, position_hi in zip(self.edges_lo[edges_kept], self.edges_hi[edges_kept]):
+            components.union(position_lo, position_hi)
+        return self.locales[components.getNodesLabel()]
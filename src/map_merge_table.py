@@ -0,0 +1,118 @@
+import numpy as np
+from src import map_dtypes
+
+##
+# MergeTable keeps the list of merges (where two locales/divisions are combined) computed in
+# LocalePartition.computeDivisionMergePoints.
+#
+# Previously every merge was its own dict, which costs a lot of memory once there are millions of merges
+# and every analysis had to rebuild arrays from it with list comprehensions.
+# Instead, each key is now a column (a numpy array with one value per merge), so analyses can use the
+# columns directly, eg. merges['bridge_lo_index'] or merges.filter(merges['bridge_hi_value'] > 0)
+#
+# Indexing with an integer or iterating over the table still gives a dict per merge for convenience.
+#
+
+# The land/sea interfaces (eg. 'LSL') are stored as small integer codes.
+# Each letter is a bit (L = 0, S = 1) with the first letter being the most significant,
+# so comparing codes works the same as comparing the strings ('LLL' < 'LLS' < ... < 'SSS' < 'UNK')
+INTERFACE_UNKNOWN = 8
+INTERFACE_UNKNOWN_NAME = 'UNK'
+
+interface_columns = ['landsea_local_interface', 'landsea_division_interface']
+column_names = [
+    'bridge_lo_index',
+    'bridge_lo_value',
+    'bridge_hi_index',
+    'bridge_hi_value',
+    'locale_lo',
+    'locale_hi',
+    'division_lo',
+    'division_hi',
+    'landsea_local_interface',
+    'landsea_division_interface',
+    'distance_between_bridge_and_hi_local_extremum',
+    'distance_between_bridge_and_hi_division_extremum',
+]
+
+def interfaceToCode(interface):
+    if interface == INTERFACE_UNKNOWN_NAME:
+        return INTERFACE_UNKNOWN
+    code = 0
+    for letter in interface:
+        code = code * 2 + (0 if letter == 'L' else 1)
+    return code
+
+def codeToInterface(code):
+    if code == INTERFACE_UNKNOWN:
+        return INTERFACE_UNKNOWN_NAME
+    return ''.join('S' if (code >> shift) & 1 else 'L' for shift in [2, 1, 0])
+
+# Gets the interface code for 3 arrays of nodes (eg. high-side extremum, bridge, low-side extremum)
+def getInterfaceCodes(nodes_value, nodes_first, nodes_middle, nodes_last):
+    nodes_sea = lambda nodes: np.logical_not(nodes_value[nodes] > 0).astype(map_dtypes.code_dtype)
+    return nodes_sea(nodes_first) * 4 + nodes_sea(nodes_middle) * 2 + nodes_sea(nodes_last)
+
+class MergeTable():
+    def __init__(self, columns):
+        self.columns = columns
+        self.n_merges = len(columns['bridge_lo_index'])
+
+    # Builds the full table from the bridge nodes & divisions recorded during the merge sweep
+    # All other columns are derived from the node values in bulk
+    @classmethod
+    def fromBridges(cls, nodes_value, nodes_locale, bridge_lo_index, bridge_hi_index, division_lo, division_hi):
+        locale_lo = nodes_locale[bridge_lo_index]
+        locale_hi = nodes_locale[bridge_hi_index]
+        return cls({
+            'bridge_lo_index': bridge_lo_index,
+            'bridge_lo_value': nodes_value[bridge_lo_index],
+            'bridge_hi_index': bridge_hi_index,
+            'bridge_hi_value': nodes_value[bridge_hi_index],
+            'locale_lo': locale_lo,
+            'locale_hi': locale_hi,
+            'division_lo': division_lo,
+            'division_hi': division_hi,
+            # Values are the high-side mountain, the bridge, then the low-side mountain
+            'landsea_local_interface': getInterfaceCodes(nodes_value, locale_hi, bridge_hi_index, locale_lo),
+            # Values are the high mountain range, the bridge, then the low mountain range
+            'landsea_division_interface': getInterfaceCodes(nodes_value, division_hi, bridge_hi_index, division_lo),
+            'distance_between_bridge_and_hi_local_extremum':
+                np.maximum(nodes_value[locale_hi], nodes_value[locale_lo]) - nodes_value[bridge_hi_index],
+            'distance_between_bridge_and_hi_division_extremum': nodes_value[division_hi] - nodes_value[bridge_hi_index],
+        })
+
+    def __len__(self):
+        return self.n_merges
+
+    # merges['column'] gives the column, merges[i] gives the i-th merge as a dict
+    # and merges[mask or indices] gives a new table with the selected merges
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        if isinstance(key, (int, np.integer)):
+            return self.getMerge(key)
+        return self.filter(key)
+
+    def __iter__(self):
+        for i_merge in range(self.n_merges):
+            yield self.getMerge(i_merge)
+
+    def getMerge(self, i_merge):
+        merge = {}
+        for key in column_names:
+            merge[key] = self.columns[key][i_merge]
+            if key in interface_columns:
+                merge[key] = codeToInterface(merge[key])
+        return merge
+
+    # Keeps the merges selected by a boolean mask or an array of merge indices
+    def filter(self, merges_selected):
+        return MergeTable({key: self.columns[key][merges_selected] for key in self.columns})
+
+    # Selects the merges that have any of the interfaces (eg. ['LSS', 'SSL'])
+    def getMergesWithInterface(self, interfaces, column='landsea_local_interface'):
+        return np.isin(self.columns[column], [interfaceToCode(interface) for interface in interfaces])
+
+    def toDicts(self):
+        return list(self)
@@ -1,20 +1,38 @@
 import numpy as np
-from src import map_image, map_instance, map_data, map_transforms
+from src import map_image, map_instance, map_data, map_transforms, map_disjoint_set, map_merge_table, map_cache, map_tiled, map_locale_graph, map_dtypes, map_disk_cache
 
 class LocalePartition():
-    def __init__ (self, dataset, region, minutes_per_node, image_folder, flow_direction, n_neighbors=4):
+    # n_processes > 1 (or None for all cores) runs the heavy steps over tiles of the map in a pool of processes, see map_tiled
+    # display_images=False never shows images (they are still saved), for batch jobs without a screen
+    # map_elevation is a MapInstance to partition instead of loading the region (eg. a synthetic map, see map_benchmark),
+    # region then only names it
+    # pack_masks=True keeps the sea, coast & locale border maps bit-packed (see MapInstance.newPackedInstance)
+    # disk_cache keeps the highest neighbors, locales & merges on disk for the next run, either a DiskCache
+    # or True for map_disk_cache.default_cache
+    def __init__ (self, dataset, region, minutes_per_node, image_folder, flow_direction, n_neighbors=4,
+                  n_processes=1, tile_size=map_tiled.default_tile_size, display_images=True, map_elevation=None,
+                  pack_masks=False, disk_cache=None):
         self.dataset = dataset
         self.region = region
         self.minutes_per_node = minutes_per_node
         self.image_folder = image_folder
         self.flow_direction = flow_direction
         self.n_neighbors = n_neighbors
+        self.n_processes = n_processes
+        self.tile_size = tile_size
+        self.display_images = display_images
+        self.map_elevation = map_elevation
+        self.pack_masks = pack_masks
+        self.disk_cache = map_disk_cache.default_cache if disk_cache is True else disk_cache
+        self.elevation_hash = None # computeBaseMaps, when there's a disk cache
+        self.cache_region = None # computeBaseMaps, the region as it's named in the map_cache keys
         
         # Early computation
         self.labels = self.getDirectionSpecificLabels()
         
         # Initialized with other functions
         self.maps = None # computeBaseMaps
+        self.locales = None # computeBaseMaps
         self.nodes_neighbors = None # computeNodeNeighbors
         self.merges = None # computeDivisionMergePoints
         
@@ -26,7 +44,7 @@ class LocalePartition():
         if draw_all_images:
             self.drawGlobalPathParentGradient()
         self.computePathInterfaceType(display_image=draw_all_images)
-        _locales_adjacency_list = self.getLocaleAdjacencyList(verbose=print_stats)
+        _locales_graph = self.getLocaleAdjacencyList(verbose=print_stats)
         
         return self
     
@@ -77,7 +95,7 @@ class LocalePartition():
 
     # Regenerate Elevation information and prepare many supporting maps
     def getImageBase(self, nodes_bg_value=None, nodes_bg_colormap='hashed', nodes_border=None):
-        image = map_image.RasterImage(self.maps['elevation']) \
+        image = map_image.RasterImage(self.maps['elevation'], display_enabled=self.display_images) \
             .addLayer('base', 1)
 
         if nodes_bg_value is not None:
@@ -96,36 +114,82 @@ class LocalePartition():
         if nodes_border is not None:
             image = image.addLayer('border', 0.5, nodes_selected=nodes_border, combine='multiply')
 
-        return image.addLayer('sea', 1.2, nodes_selected=self.maps['sea'].getDataFlat(), combine='add', dissolve=.2) \
-                .addLayer('hillshade', self.maps['hillshade'].getDataFlat(), combine='add', opacity=1, dissolve=1) \
-                .addLayer('coast', 0.2, nodes_selected=self.maps['coast'].getDataFlat(), combine='multiply')
+        return image.addLayerStack(self.getImageBaseLayerStack())
+
+    # The sea, hillshade & coast layers drawn over every image only depend on the region,
+    # so they are combined once (see map_image.getLayerStack) and shared through map_cache
+    def getImageBaseLayerStack(self):
+        return map_cache.getOrCompute(
+            (self.dataset, self.minutes_per_node, self.cache_region, 'image_base', ()),
+            lambda: map_image.getLayerStack(self.n_nodes, [
+                {'name': 'sea', 'values': 1.2, 'nodes_selected': self.maps['sea'].getDataFlat(), 'combine': 'add', 'dissolve': .2},
+                {'name': 'hillshade', 'values': self.maps['hillshade'].getDataFlat(), 'combine': 'add', 'opacity': 1, 'dissolve': 1},
+                {'name': 'coast', 'values': 0.2, 'nodes_selected': self.maps['coast'].getDataFlat(), 'combine': 'multiply'},
+            ]),
+        )
+
+    # Gets what compute() returns from the disk cache if there is one, keyed by the elevation data & the parameters
+    def cachedOnDisk(self, transform, params, compute):
+        if self.disk_cache is None:
+            return compute()
+        return self.disk_cache.getOrCompute((self.elevation_hash, transform) + params, compute)
 
     # Get the basic maps
     def computeBaseMaps(self, display_and_save_image=True):
         maps = {} # This will collect all map instances
-        maps['elevation'] = map_data.loadRegionMap(
-            region=self.region, 
-            dataset=self.dataset, 
-            minutes_per_node=self.minutes_per_node, 
-            image_folder=self.image_folder,
-        )
-        maps['hillshade'] = map_transforms.getHillshade(maps['elevation'], 1)
-        maps['sea'] = maps['elevation'].newChildInstance(
+        if self.map_elevation is not None:
+            maps['elevation'] = self.map_elevation.newChildInstance({'image_folder': self.image_folder}, self.map_elevation.data)
+            # A given map isn't the region's data, so its maps are only shared with partitions of the same data
+            self.cache_region = (self.region, map_disk_cache.getKeyHash((maps['elevation'].getDataFlat(),)))
+        else:
+            self.cache_region = self.region
+            maps['elevation'] = map_data.loadRegionMap(
+                region=self.region, 
+                dataset=self.dataset, 
+                minutes_per_node=self.minutes_per_node, 
+                image_folder=self.image_folder,
+            )
+
+        # The other base maps only depend on the data, region & flow direction, so they are shared through map_cache
+        # with other partitions of the same region
+        def cached(transform, params, compute, on_disk=False):
+            if on_disk:
+                compute = lambda compute=compute: self.cachedOnDisk(transform, params, compute)
+            return map_cache.getOrCompute((self.dataset, self.minutes_per_node, self.cache_region, transform, params), compute)
+
+        maps['hillshade'] = cached('hillshade', (1,), lambda: map_transforms.getHillshade(maps['elevation'], 1))
+        def packed(map_mask):
+            return map_mask.newPackedInstance() if self.pack_masks else map_mask
+
+        maps['sea'] = cached('sea', (), lambda: packed(maps['elevation'].newChildInstance(
             {'values': 'sea'},
             maps['elevation'].getDataFlat() < 0,
-        )
-        maps['coast'] = map_transforms.getBorder(maps['sea'], 1)
+        )))
+        maps['coast'] = cached('border', ('sea', 1), lambda: packed(map_transforms.getBorder(maps['sea'], 1)))
         if self.flow_direction == 'down':
             maps['elevation'] = maps['elevation'].newChildInstance(
                 {'values': 'gravity'},
                 -maps['elevation'].getDataFlat(),
             )
         self.n_nodes = maps['elevation'].getNumNodes()
+        if self.disk_cache is not None:
+            self.elevation_hash = map_disk_cache.getKeyHash((maps['elevation'].getDataFlat(),))
 
         # Locales
-        maps['highest_neighbor_index'] = map_transforms.getHighestNeighbor(maps['elevation'])
-        maps['locale'] = map_transforms.getLocalPeaks(maps['highest_neighbor_index'])
-        maps['locale_border'] = map_transforms.getBorder(maps['locale'], 1)
+        if self.n_processes == 1:
+            getHighestNeighbor = lambda: map_transforms.getHighestNeighbor(maps['elevation'])
+            getLocales = lambda: map_transforms.getLocales(maps['highest_neighbor_index'], maps['elevation'])
+        else:
+            getHighestNeighbor = lambda: map_tiled.getHighestNeighborTiled(
+                maps['elevation'], n_processes=self.n_processes, tile_size=self.tile_size)
+            getLocales = lambda: map_tiled.getLocalesTiled(
+                maps['highest_neighbor_index'], maps['elevation'], n_processes=self.n_processes, tile_size=self.tile_size)
+        maps['highest_neighbor_index'] = cached('highest_neighbor', (self.flow_direction, 1.5), getHighestNeighbor, on_disk=True)
+        locales = cached('locales', (self.flow_direction,), lambda: dict(zip(['map', 'summary'], getLocales())), on_disk=True)
+        maps['locale'] = locales['map']
+        self.locales = locales['summary']
+        maps['locale_border'] = cached('border', ('locale', self.flow_direction, 1),
+            lambda: packed(map_transforms.getBorder(maps['locale'], 1)))
         self.maps = maps
         
         # Display locales
@@ -133,11 +197,9 @@ class LocalePartition():
             # Elevation
             data_elevation_sqrt = maps['elevation'].getDataFlat()
             data_elevation_sqrt = np.sign(data_elevation_sqrt) * (np.abs(data_elevation_sqrt) ** 0.5)
-            map_image.RasterImage(maps['elevation']) \
+            map_image.RasterImage(maps['elevation'], display_enabled=self.display_images) \
                 .addLayer('elevation', data_elevation_sqrt, colormap='naturalish') \
-                .addLayer('sea', 1.2, nodes_selected=maps['sea'].getDataFlat(), combine='add', dissolve=.2) \
-                .addLayer('hillshade', maps['hillshade'].getDataFlat(), combine='add', opacity=1, dissolve=1) \
-                .addLayer('coast', 0.2, nodes_selected=maps['coast'].getDataFlat(), combine='multiply') \
+                .addLayerStack(self.getImageBaseLayerStack()) \
                 .overrideLayerNames([self.labels['value']]) \
                 .display().save().final()
             
@@ -162,93 +224,131 @@ class LocalePartition():
         return self
 
     def computeDivisionMergePoints(self, print_stats=False, draw_and_save_image=True):
+        # The sweep is the slowest step, so its output can be kept on disk (see map_disk_cache)
+        merge_points = self.cachedOnDisk('merges', (self.flow_direction, self.n_neighbors),
+                                         self.computeDivisionMergePointsUncached)
+        merges = merge_points['merges']
+        nodes_division_snapshot = merge_points['nodes_division_snapshot']
+
+        # Draw the map
+        if draw_and_save_image:
+            map_division = self.maps['locale'].newChildInstance({'values': 'parent_extremum'}, nodes_division_snapshot)
+            map_division_border = map_transforms.getBorder(map_division, 1)
+
+            self.getImageBase(
+                   nodes_bg_value=map_division.getDataFlat(),
+                   nodes_border=map_division_border.getDataFlat()) \
+               .overrideLayerNames([
+                   self.labels['division'],
+                   'algo2',
+                   'snapshot_at_oneeighthdone'
+               ]).display().save().final()
+
+        self.merges = merges
+        
+        if print_stats:
+            self.printEarlyDivisionStats()
+        return self
+
+    # The merge sweep of computeDivisionMergePoints
+    def computeDivisionMergePointsUncached(self):
         nodes_locale = self.maps['locale'].getDataFlat()
-        nodes_division = nodes_locale.copy()
+
+        # Divisions start as the locales and are merged together as we sweep downward
+        divisions = map_disjoint_set.DisjointSet(nodes_locale)
 
         # output data
-        merges = []
-        nodes_division_snapshot = np.zeros(self.n_nodes, dtype=int)
-        nodes_peak_division_parent = np.zeros(self.n_nodes, dtype=int) - 1 # not necessarily used
+        # Each merge combines 2 divisions, so there can't be more merges than there are locales
+        n_locales = len(self.locales['extremum_index'])
+        merges_bridge_lo_index = np.zeros(n_locales, dtype=nodes_locale.dtype)
+        merges_bridge_hi_index = np.zeros(n_locales, dtype=nodes_locale.dtype)
+        merges_division_lo = np.zeros(n_locales, dtype=nodes_locale.dtype)
+        merges_division_hi = np.zeros(n_locales, dtype=nodes_locale.dtype)
+        n_merges = 0
+        nodes_division_snapshot = np.zeros(self.n_nodes, dtype=nodes_locale.dtype)
+        nodes_peak_division_parent = np.full(self.n_nodes, -1, dtype=nodes_locale.dtype) # not necessarily used
 
         def mergeTwoRanges(lo_index, hi_index):
-            locale_lo = nodes_locale[lo_index]
-            locale_hi = nodes_locale[hi_index]
-            division_lo = nodes_division[lo_index]
-            division_hi = nodes_division[hi_index]
-            nodes_division[nodes_division == division_lo] = division_hi
+            nonlocal n_merges
+            division_lo = divisions.getLabel(lo_index)
+            division_hi = divisions.getLabel(hi_index)
+            divisions.union(lo_index, hi_index)
             nodes_peak_division_parent[division_lo] = division_hi
 
-            return {
-                'bridge_lo_index': lo_index,
-                'bridge_lo_value': nodes_value[lo_index],
-                'bridge_hi_index': hi_index,
-                'bridge_hi_value': nodes_value[hi_index],
-                'locale_lo': locale_lo,
-                'locale_hi': locale_hi,
-                'division_lo': division_lo,
-                'division_hi': division_hi,
-                'landsea_local_interface': # Values are the high-side mountain, the bridge, then the low-side mountain
-                    ('L' if nodes_value[locale_hi] > 0 else 'S') + 
-                    ('L' if nodes_value[hi_index] > 0 else 'S') + 
-                    ('L' if nodes_value[locale_lo] > 0 else 'S'),
-                'landsea_division_interface': # Values are the high mountain range, the bridge, then the low mountain range
-                    ('L' if nodes_value[division_hi] > 0 else 'S') + 
-                    ('L' if nodes_value[hi_index] > 0 else 'S') + 
-                    ('L' if nodes_value[division_lo] > 0 else 'S'),
-                'distance_between_bridge_and_hi_local_extremum':
-                    max(nodes_value[locale_hi], nodes_value[locale_lo]) - nodes_value[hi_index],
-                'distance_between_bridge_and_hi_division_extremum': nodes_value[division_hi] - nodes_value[hi_index],
-            }
+            # Only the bridge & divisions are recorded here, the rest of the merge information is filled in afterwards
+            merges_bridge_lo_index[n_merges] = lo_index
+            merges_bridge_hi_index[n_merges] = hi_index
+            merges_division_lo[n_merges] = division_lo
+            merges_division_hi[n_merges] = division_hi
+            n_merges += 1
 
         nodes_value = self.maps['elevation'].getDataFlat()
-        nodes_index_hi_to_lo = np.argsort(-nodes_value);
-        for i_explorer in np.arange(self.n_nodes):
-            explorer_index = nodes_index_hi_to_lo[i_explorer]
-            node_value = nodes_value[explorer_index]
-            explorer_division = nodes_division[explorer_index]
-
-            if i_explorer == (self.n_nodes // 8):
-                nodes_division_snapshot = nodes_division.copy()
-
-            for neighbor_index in self.nodes_neighbors[explorer_index,:]:
+        # Ties are swept in index order, so the merges come out the same on every run (see map_transforms.getNodesOrder)
+        nodes_index_hi_to_lo = map_transforms.getNodesOrder(nodes_value)
+
+        # Go through the nodes from highest to lowest with their neighbors
+        # When tiled, only the neighbors that can possibly be merges are visited (see map_tiled.getMergeCandidates)
+        def iterExplorers():
+            if self.n_processes == 1:
+                for i_explorer in np.arange(self.n_nodes):
+                    explorer_index = nodes_index_hi_to_lo[i_explorer]
+                    yield i_explorer, explorer_index, self.nodes_neighbors[explorer_index,:]
+                return
+
+            nodes_rank = np.empty(self.n_nodes, dtype=nodes_index_hi_to_lo.dtype)
+            nodes_rank[nodes_index_hi_to_lo] = map_dtypes.getNodesIndex(self.n_nodes)
+            candidates_explorer, candidates_slot = map_tiled.getMergeCandidates(
+                nodes_index_hi_to_lo, nodes_locale, self.nodes_neighbors,
+                self.maps['elevation'].getNumRows(), self.maps['elevation'].getNumCols(),
+                n_processes=self.n_processes, tile_size=self.tile_size)
+            explorers_start = np.flatnonzero(np.diff(candidates_explorer, prepend=-1))
+            explorers_end = np.append(explorers_start[1:], len(candidates_explorer))
+            for start, end in zip(explorers_start, explorers_end):
+                explorer_index = candidates_explorer[start]
+                yield nodes_rank[explorer_index], explorer_index, self.nodes_neighbors[explorer_index, candidates_slot[start:end]]
+
+        is_snapshot_taken = False
+        for i_explorer, explorer_index, explorer_neighbors in iterExplorers():
+            explorer_root = divisions.find(explorer_index)
+
+            if not is_snapshot_taken and i_explorer >= (self.n_nodes // 8):
+                nodes_division_snapshot = divisions.getNodesLabel()
+                is_snapshot_taken = True
+
+            for neighbor_index in explorer_neighbors:
                 # Exclude not wrapping neighbors and neighbors that are already in the same mountain range
-                if (neighbor_index == -1 or nodes_division[neighbor_index] == explorer_division):
+                if neighbor_index == -1:
+                    continue
+                neighbor_root = divisions.find(neighbor_index)
+                if neighbor_root == explorer_root:
                     continue
 
                 # They are different!
-                neighbor_division = nodes_division[neighbor_index]
+                explorer_division = divisions.getRootLabel(explorer_root)
+                neighbor_division = divisions.getRootLabel(neighbor_root)
 
                 if (nodes_value[explorer_division] > nodes_value[neighbor_division]):
                     # The node's mountain range is taller, merge into that
-                    mergePoint = mergeTwoRanges(neighbor_index, explorer_index)
+                    mergeTwoRanges(neighbor_index, explorer_index)
                 else:
                     # The neighbor's mountain peak is taller, merge into that
-                    mergePoint = mergeTwoRanges(explorer_index, neighbor_index)
-
-                    # Update the explorers mountain range
-                    explorer_division = neighbor_division
-                merges.append(mergePoint)
+                    mergeTwoRanges(explorer_index, neighbor_index)
 
+                # Update the explorers mountain range
+                explorer_root = divisions.find(explorer_index)
 
-        # Draw the map
-        if draw_and_save_image:
-            map_division = self.maps['locale'].newChildInstance({'values': 'parent_extremum'}, nodes_division_snapshot)
-            map_division_border = map_transforms.getBorder(map_division, 1)
+        if not is_snapshot_taken:
+            nodes_division_snapshot = divisions.getNodesLabel()
 
-            self.getImageBase(
-                   nodes_bg_value=map_division.getDataFlat(),
-                   nodes_border=map_division_border.getDataFlat()) \
-               .overrideLayerNames([
-                   self.labels['division'],
-                   'algo2',
-                   'snapshot_at_oneeighthdone'
-               ]).display().save().final()
-
-        self.merges = merges
-        
-        if print_stats:
-            self.printEarlyDivisionStats()
-        return self
+        merges = map_merge_table.MergeTable.fromBridges(
+            nodes_value,
+            nodes_locale,
+            merges_bridge_lo_index[:n_merges],
+            merges_bridge_hi_index[:n_merges],
+            merges_division_lo[:n_merges],
+            merges_division_hi[:n_merges],
+        )
+        return {'merges': merges, 'nodes_division_snapshot': nodes_division_snapshot}
 
     # Some descriptive statistics
     def printEarlyDivisionStats(self): 
@@ -257,7 +357,7 @@ class LocalePartition():
         print('How many things do we have?')
         print('{:10d} nodes (pixel), points across the map along a 2-dimensional grid'.format(len(nodes_locale)))
         print('{:10d} {locale:s}s, groupings where all of the nodes in a local area point {direction:s}ward to a single point'.format(
-            len(np.unique(nodes_locale)), locale=self.labels['locale'], direction=self.flow_direction))
+            len(self.locales['extremum_index']), locale=self.labels['locale'], direction=self.flow_direction))
         print('{:14s} {extremum:s}s are the {direction_adj:s}est point in these {locale:s}s and are used to index them'.format(
             '', extremum=self.labels['extremum'], locale=self.labels['locale'], direction_adj=self.labels['direction_adjective']))
         print('{:10d} merges, times where two {:s}s are combined, based on the {direction_adj:s}est point outward from a {:s}'.format(
@@ -273,12 +373,12 @@ class LocalePartition():
 
         print('')
         print('Do the {path:s}s in the connections cross the water line / interface? Considering what is above water (L) or below (S)?'.format(path=self.labels['path']))
-        landsea_local_interfaces = np.array([x['landsea_local_interface'] for x in self.merges])
-        landsea_division_interfaces = np.array([x['landsea_division_interface'] for x in self.merges])
+        landsea_local_interfaces = self.merges['landsea_local_interface']
+        landsea_division_interfaces = self.merges['landsea_division_interface']
         print('{:18s}: {:6s} {:6s}'.format('Interface Pattern','Local','Divisions'))
-        for interface_pattern in sorted(np.unique(landsea_local_interfaces)):
+        for interface_pattern in np.unique(landsea_local_interfaces):
             print('{:18s}: {:6d} {:6d}'.format(
-                interface_pattern,
+                map_merge_table.codeToInterface(interface_pattern),
                 np.sum(landsea_local_interfaces == interface_pattern),
                 np.sum(landsea_division_interfaces == interface_pattern),
             ))
@@ -289,8 +389,8 @@ class LocalePartition():
         print('    local = neighboring {locale:s}s, divisions = among the {division:s} it is connected to.'.format(
             locale=self.labels['locale'], division=self.labels['division']))
         log_base = 10 ** 0.5
-        local_distances_logged_rounded = np.log(np.array([x['distance_between_bridge_and_hi_local_extremum'] for x in self.merges])+0.001) // np.log(log_base)
-        range_distances_logged_rounded = np.log(np.array([x['distance_between_bridge_and_hi_division_extremum'] for x in self.merges])+0.001) // np.log(log_base)
+        local_distances_logged_rounded = np.log(self.merges['distance_between_bridge_and_hi_local_extremum']+0.001) // np.log(log_base)
+        range_distances_logged_rounded = np.log(self.merges['distance_between_bridge_and_hi_division_extremum']+0.001) // np.log(log_base)
         print('{:16s}: {:6s} {:6s}'.format('Distance','Local','Divisions'))
         for distance_group in sorted(np.unique(range_distances_logged_rounded)):
             group_min = int(np.exp(distance_group * np.log(log_base)))
@@ -308,22 +408,15 @@ class LocalePartition():
         nodes_lo_bridge = np.zeros(self.n_nodes, dtype=bool)
         nodes_hi_bridge = np.zeros(self.n_nodes, dtype=bool)
 
-        for i_merge in np.arange(len(self.merges)):
-            merge = self.merges[i_merge]
-            bridge_lo_index = merge['bridge_lo_index']
-            bridge_hi_index = merge['bridge_hi_index']
-            nodes_lo_bridge[bridge_lo_index] = True
-            nodes_hi_bridge[bridge_hi_index] = True
-
-            # Follow the nodes upward from the bridge on both sides, marking those as ridge nodes
-            cur_node = bridge_lo_index
-            while cur_node != HAS_NO_HIGHER_NEIGHBOR:
-                nodes_path[cur_node] = True
-                cur_node = nodes_highest_neighbor_index[cur_node]
-            cur_node = bridge_hi_index
-            while cur_node != HAS_NO_HIGHER_NEIGHBOR:
-                nodes_path[cur_node] = True
-                cur_node = nodes_highest_neighbor_index[cur_node]
+        nodes_lo_bridge[self.merges['bridge_lo_index']] = True
+        nodes_hi_bridge[self.merges['bridge_hi_index']] = True
+
+        # Follow the nodes upward from the bridge on both sides, marking those as ridge nodes
+        map_transforms.markPathsToPeaks(
+            nodes_highest_neighbor_index,
+            np.concatenate([self.merges['bridge_lo_index'], self.merges['bridge_hi_index']]),
+            nodes_path,
+        )
                 
         # # Temporarily disabling this until we need the data
         # self.maps['path'] = self.maps['highest_neighbor_index'].newChildInstance(
@@ -348,34 +441,28 @@ class LocalePartition():
 
     # Go through all merge lines and compute how far each node is from the node with the largest value
     def drawGlobalPathParentGradient(self):
-        nodes_global_path_parent = self.maps['highest_neighbor_index'].getDataFlat()
-
-        for merge in reversed(self.merges):
-            node_being_flipped = merge['bridge_lo_index']
-            node_new_uphill = merge['bridge_hi_index']
-
-            while node_being_flipped != -1:
-                node_old_uphill = nodes_global_path_parent[node_being_flipped]
-                nodes_global_path_parent[node_being_flipped] = node_new_uphill
-                node_new_uphill = node_being_flipped
-                node_being_flipped = node_old_uphill
+        nodes_highest_neighbor_index = self.maps['highest_neighbor_index'].getDataFlat()
+        merges_bridge_lo_index = self.merges['bridge_lo_index']
+        merges_bridge_hi_index = self.merges['bridge_hi_index']
+
+        # Going from the last merge to the first, each merge re-routes the path from the low-side bridge to its extremum
+        # so it flows into the high-side bridge instead. The paths & bridges together still make a tree, so rather than
+        # flipping each path one node at a time we only need to know which extremum ends up as the root of the tree.
+        # Each merge hangs the low side's tree (and its current root) under the high side's tree.
+        trees = map_disjoint_set.DisjointSet(self.maps['locale'].getDataFlat())
+        for bridge_lo_index, bridge_hi_index in zip(merges_bridge_lo_index[::-1], merges_bridge_hi_index[::-1]):
+            trees.union(bridge_lo_index, bridge_hi_index)
+        nodes_global_extremum = np.unique(trees.getNodesLabel())
 
         # Now we have a new river graph, let's redo the distance
-        nodes_distance_from_global_extremum = np.zeros(self.n_nodes, dtype=int)
-
         # This time we cannot go by the elevations because some low-elevation nodes may be "higher" in this new river graph
-        # so we have to iterate through the 
-        exploring_nodes = np.where(nodes_global_path_parent == -1)[0]
-
-        for i_node in np.arange(self.n_nodes):
-            node_index = exploring_nodes[i_node]
-
-            uphill_node_index = nodes_global_path_parent[node_index]
-            node_distance = 0 if uphill_node_index == -1 else nodes_distance_from_global_extremum[uphill_node_index]
-            nodes_distance_from_global_extremum[node_index] = node_distance + 1
-
-            # Add next nodes to the queue
-            exploring_nodes = np.append(exploring_nodes, np.where(nodes_global_path_parent == node_index)[0])
+        # so we have to explore outward from the global extremums, one level at a time
+        nodes_uphill = np.flatnonzero(nodes_highest_neighbor_index != -1)
+        edges_from = np.concatenate([nodes_uphill, nodes_highest_neighbor_index[nodes_uphill], merges_bridge_lo_index, merges_bridge_hi_index])
+        edges_to = np.concatenate([nodes_highest_neighbor_index[nodes_uphill], nodes_uphill, merges_bridge_hi_index, merges_bridge_lo_index])
+        offsets, nodes_neighbor = map_transforms.getCompressedAdjacency(edges_from, edges_to, self.n_nodes)
+        _nodes_global_path_parent, nodes_depth = map_transforms.getTreeParentAndDepth(offsets, nodes_neighbor, nodes_global_extremum)
+        nodes_distance_from_global_extremum = nodes_depth + 1
 
         # Draw the locales by their distance from the extremums
         nodes_global_distance_normed = -nodes_distance_from_global_extremum
@@ -388,38 +475,42 @@ class LocalePartition():
 
     def computePathInterfaceType(self, display_image=False):
         nodes_highest_neighbor_index = self.maps['highest_neighbor_index'].getDataFlat()
-        nodes_path_interface = np.full(self.n_nodes, 'UNK')
+        # Interfaces are the codes from map_merge_table, which are ordered the same way as the strings
+        nodes_path_interface = np.full(self.n_nodes, map_merge_table.INTERFACE_UNKNOWN, dtype=map_dtypes.code_dtype)
         nodes_bridge = np.zeros(self.n_nodes, dtype=bool)
-        nodes_locale_merge_interface = np.full(self.n_nodes, 'UNK')
+        nodes_locale_merge_interface = np.full(self.n_nodes, map_merge_table.INTERFACE_UNKNOWN, dtype=map_dtypes.code_dtype)
         nodes_value = self.maps['elevation'].getDataFlat()
 
-        for merge in self.merges:
-            node_lo = merge['bridge_lo_index']
-            node_hi = merge['bridge_hi_index']
-            merge_interface = merge['landsea_local_interface']
-
-            nodes_bridge[node_lo] = True
-            nodes_bridge[node_hi] = True
-
-            # Determine the type of paths from both merge points to their local extremum
-            cur_node = node_lo
-            while cur_node != -1:
-                nodes_path_interface[cur_node] = min(merge_interface, nodes_path_interface[cur_node])
-                nodes_locale_merge_interface[cur_node] = min(merge_interface, nodes_locale_merge_interface[cur_node])
-                cur_node = nodes_highest_neighbor_index[cur_node]
-            cur_node = node_hi
-            while cur_node != -1:
-                nodes_path_interface[cur_node] = min(merge_interface, nodes_path_interface[cur_node])
-                cur_node = nodes_highest_neighbor_index[cur_node]
+        nodes_bridge[self.merges['bridge_lo_index']] = True
+        nodes_bridge[self.merges['bridge_hi_index']] = True
+
+        # Determine the type of paths from both merge points to their local extremum
+        # Each node gets the lowest interface of all the paths through it, so we go through the interfaces
+        # from lowest to highest and each time only mark the path nodes that don't have an interface yet
+        nodes_on_path = np.zeros(self.n_nodes, dtype=bool)
+        nodes_on_lo_path = np.zeros(self.n_nodes, dtype=bool)
+        merges_interface = self.merges['landsea_local_interface']
+        for merge_interface in np.unique(merges_interface):
+            merges_selected = merges_interface == merge_interface
+            nodes_lo = self.merges['bridge_lo_index'][merges_selected]
+            nodes_hi = self.merges['bridge_hi_index'][merges_selected]
+
+            nodes_newly_on_path = map_transforms.markPathsToPeaks(
+                nodes_highest_neighbor_index, np.concatenate([nodes_lo, nodes_hi]), nodes_on_path)
+            nodes_path_interface[nodes_newly_on_path] = merge_interface
+            nodes_newly_on_lo_path = map_transforms.markPathsToPeaks(
+                nodes_highest_neighbor_index, nodes_lo, nodes_on_lo_path)
+            nodes_locale_merge_interface[nodes_newly_on_lo_path] = merge_interface
 
         # Draw the map
         if display_image:
+            code = map_merge_table.interfaceToCode
             self.getImageBase() \
-                .addLayer('ridge_merged_LLL', [.75, .75,   0], nodes_selected=(nodes_path_interface == 'LLL'), combine='set') \
-                .addLayer('ridge_merged_SSS', [  0,  .5, .75], nodes_selected=(nodes_path_interface == 'SSS'), combine='set') \
-                .addLayer('ridge_merged_LSS', [  0, .75,   0], nodes_selected=(nodes_path_interface == 'LSS'), combine='set') \
-                .addLayer('ridge_merged_LSL', [.75,   0, .75], nodes_selected=(nodes_path_interface == 'LSL'), combine='set') \
-                .addLayer('ridge_merged_LLS', [.75,   0,   0], nodes_selected=(nodes_path_interface == 'LLS'), combine='set') \
+                .addLayer('ridge_merged_LLL', [.75, .75,   0], nodes_selected=(nodes_path_interface == code('LLL')), combine='set') \
+                .addLayer('ridge_merged_SSS', [  0,  .5, .75], nodes_selected=(nodes_path_interface == code('SSS')), combine='set') \
+                .addLayer('ridge_merged_LSS', [  0, .75,   0], nodes_selected=(nodes_path_interface == code('LSS')), combine='set') \
+                .addLayer('ridge_merged_LSL', [.75,   0, .75], nodes_selected=(nodes_path_interface == code('LSL')), combine='set') \
+                .addLayer('ridge_merged_LLS', [.75,   0,   0], nodes_selected=(nodes_path_interface == code('LLS')), combine='set') \
                 .addLayer('bridge', 2, nodes_selected=nodes_bridge, combine='multiply') \
                 .overrideLayerNames([
                     'merge_interfaces'
@@ -433,31 +524,17 @@ class LocalePartition():
 
         return self
 
+    # The graph of which locales were merged together, see map_locale_graph
     def getLocaleAdjacencyList(self, verbose=False):
-        locales_adjacency_list = {}
-
-        for merge in self.merges:
-            node_lo = merge['bridge_lo_index']
-            node_hi = merge['bridge_hi_index']
-            m1 = merge['locale_lo']
-            m2 = merge['locale_hi']
-
-            if m1 in locales_adjacency_list:
-                locales_adjacency_list[m1] = np.append(locales_adjacency_list[m1], m2)
-            else:
-                locales_adjacency_list[m1] = np.array([m2])
-            if m2 in locales_adjacency_list:
-                locales_adjacency_list[m2] = np.append(locales_adjacency_list[m2], m1)
-            else:
-                locales_adjacency_list[m2] = np.array([m1])
+        locales_graph = map_locale_graph.LocaleGraph.fromMerges(self.locales['extremum_index'], self.merges)
 
         if verbose:
             # Print out descriptive statistics
-            locales_adjacency_list_cardinality = np.array([len(locales_adjacency_list[x]) for x in locales_adjacency_list])
-            n_locales_1_connection = np.sum(locales_adjacency_list_cardinality == 1)
-            n_locales_2_connections = np.sum(locales_adjacency_list_cardinality == 2)
-            n_locales_morethan5_connections = np.sum(locales_adjacency_list_cardinality > 5)
-            n_locales_3to5_connections = len(locales_adjacency_list) - n_locales_1_connection - n_locales_2_connections - n_locales_morethan5_connections
+            locales_degree_histogram = np.pad(locales_graph.getDegreeHistogram(), (0, 7))
+            n_locales_1_connection = locales_degree_histogram[1]
+            n_locales_2_connections = locales_degree_histogram[2]
+            n_locales_3to5_connections = np.sum(locales_degree_histogram[3:6])
+            n_locales_morethan5_connections = np.sum(locales_degree_histogram[6:])
             print((
                     '{locale:s}s with   1 connection : {:6d}\n' +
                     '{locale:s}s with   2 connections: {:6d}\n' +
@@ -472,63 +549,44 @@ class LocalePartition():
                       locale=self.labels['locale'],
                   ))
 
-        return locales_adjacency_list
+        return locales_graph
     
-    # Function to split a part of a division (group of locales) to a new division
-    def getNodesDivisionAfterPartition(self, nodes_division, dividing_locale, locales_adjacency_list, nodes_value):
-        exploring_locales = [dividing_locale];
-        extremum = dividing_locale;
-
-        # Assign all recursive neighbors of dividing_locale to its group
-        while len(exploring_locales) > 0:
-            new_locale = exploring_locales.pop()
-            if(nodes_value[new_locale] > nodes_value[extremum]):
-                extremum = new_locale # Determine the final maximal point of the new division
-            for neighbor_locale in locales_adjacency_list[new_locale]:
-                if nodes_division[neighbor_locale] != dividing_locale:
-                    nodes_division[neighbor_locale] = dividing_locale
-                    exploring_locales.append(neighbor_locale)
-
-        # Reassign that whole new division to the maximum point in that division
-        nodes_division[nodes_division == dividing_locale] = extremum
-
-        return nodes_division
-
     def drawDivisionsAcrossSeaLevel(self, print_filenames=False, display_images=False, final_analysis_filename=False):
         interfaces_to_split = ['LSL'] if self.flow_direction == 'up' else ['LSS', 'SSL']
         compare_across_full_path = self.flow_direction == 'up' 
         
         nodes_locale = self.maps['locale'].getDataFlat() # Use this to color the whole locales by the new division
         nodes_value = self.maps['elevation'].getDataFlat() # Use this to see if a extremum is above or below water
-        locales_adjacency_list = self.getLocaleAdjacencyList() # start from scratch because we will actively edit it
+        locales = self.locales['extremum_index']
 
         # The data we are computing
-        node_global_extremum_index = np.argsort(nodes_value)[0] # This is the parent locale to all others
-        nodes_division = np.full(self.n_nodes, node_global_extremum_index) # Start with everything being unified under this peak
-        n_locales = len(locales_adjacency_list)
-
-        # Iterate over the merge
-        for merge in self.merges:
-            # Only split up merges in the list of interfaces to split up
-            merge_interface = merge['landsea_division_interface'] \
-                if compare_across_full_path else merge['landsea_local_interface']
-            if merge_interface not in interfaces_to_split:
-                continue
-
-            # Break the adjacency
-            m1 = merge['locale_lo']
-            m2 = merge['locale_hi']
-            locales_adjacency_list[m1] = np.setdiff1d(locales_adjacency_list[m1], [m2])
-            locales_adjacency_list[m2] = np.setdiff1d(locales_adjacency_list[m2], [m1])
-
-            # Compute the new groups (using stand-in values for the highest extremum)
-            # Note: We are doing double work since we don't know which side the overall extremum is on
-            nodes_division = self.getNodesDivisionAfterPartition(nodes_division, m1, locales_adjacency_list, nodes_value)
-            nodes_division = self.getNodesDivisionAfterPartition(nodes_division, m2, locales_adjacency_list, nodes_value)
-
-        # Finally expand the division color to all nodes
-        for locale_index in np.arange(len(nodes_locale)):
-            nodes_division[nodes_locale == locale_index] = nodes_division[locale_index]
+        node_global_extremum_index = np.argmin(nodes_value) # This is the parent locale to all others
+
+        # Only split up merges in the list of interfaces to split up
+        merges_is_split = self.merges.getMergesWithInterface(
+            interfaces_to_split,
+            'landsea_division_interface' if compare_across_full_path else 'landsea_local_interface',
+        )
+
+        # Rather than breaking the merges one at a time and reflooding the divisions after each one,
+        # remove all of them from the locale graph and find what is still connected, all at once
+        locales_graph = self.getLocaleAdjacencyList().removeEdges(merges_is_split)
+        locales_division = locales_graph.getComponents()
+        nodes_division_id = locales_division[locales_graph.getLocalePosition(nodes_locale)]
+
+        # Each division is named after its highest locale (the first one in index order if tied)
+        locales_order = np.lexsort((locales, -nodes_value[locales]))
+        divisions_id, divisions_first = np.unique(locales_division[locales_order], return_index=True)
+        divisions_extremum = locales[locales_order[divisions_first]]
+
+        # Divisions that weren't split off from anything stay unified under the global extremum
+        merges_split = self.merges.filter(merges_is_split)
+        divisions_is_split = np.isin(divisions_id, nodes_division_id[merges_split['locale_lo']]) | \
+            np.isin(divisions_id, nodes_division_id[merges_split['locale_hi']])
+        divisions_extremum[~divisions_is_split] = node_global_extremum_index
+
+        # Finally expand the division color to all nodes, in one gather
+        nodes_division = divisions_extremum[np.searchsorted(divisions_id, nodes_division_id)]
 
         map_division = self.maps['locale'].newChildInstance({'values': 'division'}, nodes_division)
         map_division_border = map_transforms.getBorder(map_division, 1)
@@ -0,0 +1,59 @@
+import struct
+import zlib
+import numpy as np
+
+##
+# Writes 8-bit PNG images a band of rows at a time, using only zlib.
+#
+# matplotlib's imsave needs the whole image as a float array and imports pyplot, so saving a large image
+# costs several full-size copies. Here the rows are quantized, filtered & compressed band by band
+# so only one band is ever held besides the caller's own data.
+#
+# Rows use the PNG 'up' filter (difference from the row above), which suits maps since most rows
+# look a lot like the one above them.
+#
+default_band_size = 256
+default_compression_level = 6
+png_signature = b'\x89PNG\r\n\x1a\n'
+color_types = {1: 0, 2: 4, 3: 2, 4: 6} # number of channels -> PNG color type (gray, gray+alpha, RGB, RGBA)
+filter_up = 2
+
+# bands should yield uint8 arrays of [n_band_rows, n_cols, n_channels], together covering all n_rows
+def savePNG(filename, n_rows, n_cols, n_channels, bands, compression_level=default_compression_level):
+    assert (n_channels in color_types), 'Number of channels must be one of: ' + str(list(color_types))
+    png_file = open(filename, 'wb')
+    png_file.write(png_signature)
+    _writeChunk(png_file, b'IHDR', struct.pack('>IIBBBBB', n_cols, n_rows, 8, color_types[n_channels], 0, 0, 0))
+
+    compressor = zlib.compressobj(compression_level)
+    row_previous = np.zeros(n_cols * n_channels, dtype=np.uint8)
+    n_rows_written = 0
+    for band in bands:
+        band = band.reshape([-1, n_cols * n_channels])
+        band_filtered = np.empty([band.shape[0], band.shape[1] + 1], dtype=np.uint8)
+        band_filtered[:, 0] = filter_up
+        np.subtract(band[:1], row_previous, out=band_filtered[:1, 1:])
+        np.subtract(band[1:], band[:-1], out=band_filtered[1:, 1:])
+        row_previous = band[-1].copy()
+        n_rows_written += band.shape[0]
+
+        data = compressor.compress(band_filtered.tobytes())
+        if len(data) > 0:
+            _writeChunk(png_file, b'IDAT', data)
+
+    assert (n_rows_written == n_rows), 'Bands must cover all of the rows'
+    _writeChunk(png_file, b'IDAT', compressor.flush())
+    _writeChunk(png_file, b'IEND', b'')
+    png_file.close()
+
+def _writeChunk(png_file, chunk_type, data):
+    png_file.write(struct.pack('>I', len(data)))
+    png_file.write(chunk_type)
+    png_file.write(data)
+    png_file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+# Quantizes colors in [0, 1] to uint8 the same way matplotlib does (truncating)
+def getColorsUint8(colors):
+    if colors.dtype == np.uint8:
+        return colors
+    return (colors * 255).astype(np.uint8)
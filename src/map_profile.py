@@ -0,0 +1,201 @@
+##
+# Opt-in instrumentation of the public steps of the map modules, to find which step of a slow run is at fault
+#
+#   with map_profile.profiling(filename='run.jsonl'):
+#       map_partition.LocalePartition(...).computeStandardDivisionInformation()
+#
+# While enabled, every public function & method of the modules (map_partition, map_transforms, map_data & map_image
+# by default) is wrapped to record its wall time, CPU time, the peak RSS of the process so far, and the counts
+# it can find on its arguments & result: nodes, locales, merges and image layers. Steps called from within other
+# steps are recorded too, with their depth. Each record is a dict, written as a line of JSON and/or passed to
+# the callback (eg. to feed a dashboard).
+#
+# The peak RSS (process_peak_rss_bytes) is the high-water mark of the whole process up to the end of the step,
+# not the step's own peak, so a step only shows up in it when it uses more memory than every step before it.
+#
+# Helpers called once per stencil offset (the aggregated_steps) would fill the records with near-identical entries,
+# so their calls are summed into one record per step they're called from, with the number of calls.
+#
+# The wrappers are only installed by enable() and are removed again by disable(), so when profiling is off
+# the modules are untouched and there is no overhead at all. Generator functions (eg. map_data.iterWorldBands)
+# aren't wrapped since their work happens after they return, and neither is the work done in pools of processes.
+#
+import contextlib
+import functools
+import inspect
+import json
+import os
+import sys
+import time
+from src import map_partition, map_transforms, map_data, map_image, map_instance
+
+try:
+    import resource # not on Windows, where the peak RSS isn't recorded
+except ImportError:
+    resource = None
+
+default_modules = [map_partition, map_transforms, map_data, map_image]
+
+# Steps (or classes of them) that are recorded as one sum per calling step
+aggregated_steps = ['src.map_transforms.Stencil', 'src.map_transforms.getNodesNeighborForOffset']
+
+# The state of the profiling while it's enabled
+_profile = None
+
+def enable(filename=None, callback=None, modules=None):
+    global _profile
+    assert (_profile is None), 'Profiling is already enabled'
+    assert (filename is not None or callback is not None), 'Records need a filename and/or a callback'
+    _profile = {
+        'pid': os.getpid(), # forked worker processes inherit the wrappers, but don't record
+        'file': open(filename, 'a') if filename is not None else None,
+        'callback': callback,
+        'depth': 0,
+        'aggregates': [{}], # for each step running, the sums of the aggregated steps called from it
+        'patched': [], # (owner, name, original attribute) to put back
+    }
+    for module in (modules if modules is not None else default_modules):
+        _patchModule(module)
+
+def disable():
+    global _profile
+    if _profile is None:
+        return
+    for owner, name, attribute in reversed(_profile['patched']):
+        setattr(owner, name, attribute)
+    _emitAggregates(_profile, _profile['aggregates'].pop(), 0) # those called from outside of any step
+    if _profile['file'] is not None:
+        _profile['file'].close()
+    _profile = None
+
+def isEnabled():
+    return _profile is not None
+
+@contextlib.contextmanager
+def profiling(filename=None, callback=None, modules=None):
+    enable(filename, callback, modules)
+    try:
+        yield
+    finally:
+        disable()
+
+def _patchModule(module):
+    for name, attribute in list(vars(module).items()):
+        if name.startswith('_') or getattr(attribute, '__module__', None) != module.__name__:
+            continue
+        if inspect.isclass(attribute):
+            _patchClass(attribute, module.__name__)
+        elif inspect.isfunction(attribute) and not inspect.isgeneratorfunction(attribute):
+            _patch(module, name, attribute, _wrap(attribute, module.__name__ + '.' + name))
+
+def _patchClass(cls, module_name):
+    for name, attribute in list(vars(cls).items()):
+        if name.startswith('_'):
+            continue
+        step = module_name + '.' + cls.__name__ + '.' + name
+        if isinstance(attribute, (classmethod, staticmethod)):
+            if not inspect.isgeneratorfunction(attribute.__func__):
+                _patch(cls, name, attribute, type(attribute)(_wrap(attribute.__func__, step)))
+        elif inspect.isfunction(attribute) and not inspect.isgeneratorfunction(attribute):
+            _patch(cls, name, attribute, _wrap(attribute, step))
+
+def _patch(owner, name, attribute, wrapper):
+    _profile['patched'].append((owner, name, attribute))
+    setattr(owner, name, wrapper)
+
+def _wrap(function, step):
+    aggregated_step = next((name for name in aggregated_steps if step == name or step.startswith(name + '.')), None)
+    if aggregated_step is not None:
+        return _wrapAggregated(function, aggregated_step)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profile = _profile
+        if profile is None or profile['pid'] != os.getpid(): # disabled while running, or in a worker process
+            return function(*args, **kwargs)
+
+        depth = profile['depth']
+        profile['depth'] += 1
+        profile['aggregates'].append({})
+        time_start = time.time()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            value = function(*args, **kwargs)
+        finally:
+            profile['depth'] -= 1
+            aggregates = profile['aggregates'].pop()
+        record = {
+            'step': step,
+            'depth': depth,
+            'start': time_start,
+            'wall_seconds': time.perf_counter() - wall_start,
+            'cpu_seconds': time.process_time() - cpu_start,
+            'process_peak_rss_bytes': _getPeakRSS(),
+        }
+        record.update(_getCounts(value, args))
+        _emitAggregates(profile, aggregates, depth + 1)
+        _emit(profile, record)
+        return value
+    return wrapper
+
+# Adds the time of each call to the sum for the step it's called from, the sums are recorded when that step ends
+def _wrapAggregated(function, step):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profile = _profile
+        if profile is None or profile['pid'] != os.getpid():
+            return function(*args, **kwargs)
+
+        time_start = time.time()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            aggregate = profile['aggregates'][-1].setdefault(step, {
+                'step': step, 'start': time_start, 'wall_seconds': 0, 'cpu_seconds': 0, 'n_calls': 0,
+            })
+            aggregate['wall_seconds'] += time.perf_counter() - wall_start
+            aggregate['cpu_seconds'] += time.process_time() - cpu_start
+            aggregate['n_calls'] += 1
+    return wrapper
+
+def _emitAggregates(profile, aggregates, depth):
+    for aggregate in aggregates.values():
+        record = {'step': aggregate['step'], 'depth': depth}
+        record.update(aggregate)
+        record['process_peak_rss_bytes'] = _getPeakRSS()
+        _emit(profile, record)
+
+def _emit(profile, record):
+    if profile['file'] is not None:
+        profile['file'].write(json.dumps(record) + '\n')
+        profile['file'].flush()
+    if profile['callback'] is not None:
+        profile['callback'](record)
+
+def _getPeakRSS():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024 # kilobytes on Linux
+
+# The counts found on the result first, then the arguments (eg. self)
+def _getCounts(value, args):
+    counts = {}
+    for item in (value,) + args:
+        if isinstance(item, map_instance.MapInstance):
+            counts.setdefault('n_nodes', int(item.getNumNodes()))
+        elif isinstance(item, map_partition.LocalePartition):
+            # Steps run while it's being constructed see it without its attributes yet
+            if getattr(item, 'maps', None) is not None:
+                counts.setdefault('n_nodes', int(item.maps['elevation'].getNumNodes()))
+            if getattr(item, 'locales', None) is not None:
+                counts.setdefault('n_locales', len(item.locales['extremum_index']))
+            if getattr(item, 'merges', None) is not None:
+                counts.setdefault('n_merges', len(item.merges))
+        elif isinstance(item, map_image.RasterImage) and hasattr(item, 'layer_names'):
+            counts.setdefault('n_nodes', int(item.n_nodes))
+            counts.setdefault('n_layers', len(item.layer_names))
+    return counts
@@ -0,0 +1,101 @@
+import json
+import multiprocessing
+import os
+import numpy as np
+from src import map_png
+
+##
+# Writes an image as a pyramid of fixed size tiles, for browsing maps too large to open as one PNG
+#
+# Zoom level 0 is the whole map shrunk down to fit in one tile, and every level after it doubles the resolution
+# up to the full resolution image. Tiles are saved as {folder}/{zoom}/{tile_row}/{tile_col}.png with the edge tiles
+# padded out with transparent pixels, and info.json keeps the dimensions.
+#
+# The image is read in one pass, a band of rows at a time: each band is cut into tiles and averaged down (2x2) into
+# the next level, which cuts its own tiles once it has a full row of them, and so on. Only about one row of tiles
+# per level is kept in memory. Tiles that are fully transparent or fully skipped (eg. only ocean) aren't written.
+#
+default_tile_size = 256
+
+def getNumLevels(n_rows, n_cols, tile_size=default_tile_size):
+    n_levels = 1
+    while max(n_rows, n_cols) > tile_size * 2**(n_levels - 1):
+        n_levels += 1
+    return n_levels
+
+# bands should yield uint8 colors [n_band_rows, n_cols, 4] together covering the image, and nodes_skip_bands
+# the matching [n_band_rows, n_cols] bool masks of the nodes that don't need to be drawn (or None to keep all tiles)
+def savePyramid(folder, n_rows, n_cols, bands, nodes_skip_bands=None, tile_size=default_tile_size, n_processes=None):
+    assert (tile_size % 2 == 0), 'Tile size must be even'
+    n_levels = getNumLevels(n_rows, n_cols, tile_size)
+    os.makedirs(folder, exist_ok=True)
+    info_file = open(os.path.join(folder, 'info.json'), 'w')
+    json.dump({'n_rows': int(n_rows), 'n_cols': int(n_cols), 'tile_size': tile_size, 'n_levels': n_levels}, info_file)
+    info_file.close()
+
+    # Rows waiting for a full row of tiles at each level (full resolution first), and the next tile row to cut
+    levels_colors = [None] * n_levels
+    levels_skip = [None] * n_levels
+    levels_tile_row = [0] * n_levels
+    summary = {'n_levels': n_levels, 'n_tiles_saved': 0, 'n_tiles_skipped': 0}
+
+    def getTiles(i_level, colors, skip):
+        zoom = n_levels - 1 - i_level
+        tile_row = levels_tile_row[i_level]
+        levels_tile_row[i_level] += 1
+        for tile_col, xmin in enumerate(range(0, colors.shape[1], tile_size)):
+            tile_colors = colors[:, xmin:xmin + tile_size]
+            if np.all(tile_colors[:, :, 3] == 0) or np.all(skip[:, xmin:xmin + tile_size]):
+                summary['n_tiles_skipped'] += 1
+                continue
+            tile = np.zeros([tile_size, tile_size, 4], dtype=np.uint8)
+            tile[:tile_colors.shape[0], :tile_colors.shape[1]] = tile_colors
+            summary['n_tiles_saved'] += 1
+            yield os.path.join(folder, str(zoom), str(tile_row), str(tile_col) + '.png'), tile
+
+    def addRows(i_level, colors, skip, is_last):
+        if levels_colors[i_level] is not None:
+            colors = np.concatenate([levels_colors[i_level], colors])
+            skip = np.concatenate([levels_skip[i_level], skip])
+        while len(colors) >= tile_size or (is_last and len(colors) > 0):
+            yield from getTiles(i_level, colors[:tile_size], skip[:tile_size])
+            if i_level + 1 < n_levels:
+                yield from addRows(i_level + 1, *_getDownsampled(colors[:tile_size], skip[:tile_size]), False)
+            colors, skip = colors[tile_size:], skip[tile_size:]
+        levels_colors[i_level], levels_skip[i_level] = colors, skip
+
+    def iterTiles():
+        skip_bands = iter(nodes_skip_bands) if nodes_skip_bands is not None else None
+        for band in bands:
+            band_skip = next(skip_bands) if skip_bands is not None else np.zeros(band.shape[:2], dtype=bool)
+            yield from addRows(0, band, band_skip, False)
+
+        # Then cut the leftover rows at each level into the last row of tiles
+        for i_level in range(n_levels):
+            if levels_colors[i_level] is not None:
+                yield from addRows(i_level, levels_colors[i_level][:0], levels_skip[i_level][:0], True)
+
+    if n_processes == 1:
+        for task in iterTiles():
+            _saveTile(task)
+    else:
+        with multiprocessing.Pool(n_processes) as pool:
+            for _ in pool.imap_unordered(_saveTile, iterTiles(), chunksize=16):
+                pass
+    return summary
+
+def _saveTile(task):
+    filename, tile = task
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    map_png.savePNG(filename, tile.shape[0], tile.shape[1], 4, [tile])
+
+# Halves the colors (averaging 2x2 blocks) & the skip mask (skipped only if all 4 are skipped)
+# Odd rows & columns at the edge are averaged with themselves
+def _getDownsampled(colors, skip):
+    n_rows, n_cols = skip.shape
+    pad = ((0, n_rows % 2), (0, n_cols % 2))
+    colors = np.pad(colors, pad + ((0, 0),), mode='edge').astype(np.uint16)
+    skip = np.pad(skip, pad, mode='edge')
+    colors_sum = colors[0::2, 0::2] + colors[1::2, 0::2] + colors[0::2, 1::2] + colors[1::2, 1::2]
+    skip_all = skip[0::2, 0::2] & skip[1::2, 0::2] & skip[0::2, 1::2] & skip[1::2, 1::2]
+    return ((colors_sum + 2) // 4).astype(np.uint8), skip_all
@@ -0,0 +1,170 @@
+##
+# Runs the heavy but mostly local steps of LocalePartition across tiles of the map in a pool of processes
+#
+# The map is cut into square tiles and each tile is worked on along with a halo around it (the nodes just outside
+# of the tile that its nodes look at). The results of the tiles are stitched back together so they are identical
+# to running the step on the whole map at once:
+#   getHighestNeighborTiled: each tile's stencil is padded from the whole map, so the tiles are independent
+#   getLocalesTiled: each tile follows the highest neighbors as far as it can inside the tile, then the paths
+#       that cross between tiles are finished on the whole map (they only take a few more rounds)
+#   getMergeCandidates: each tile throws out the neighbor pairs that can't be a merge, see below
+#
+import multiprocessing
+import numpy as np
+from src import map_transforms
+
+default_tile_size = 1024
+
+def getTiles(n_rows, n_cols, tile_size=default_tile_size):
+    tiles = []
+    for ymin in range(0, n_rows, tile_size):
+        for xmin in range(0, n_cols, tile_size):
+            tiles.append((ymin, min(ymin + tile_size, n_rows), xmin, min(xmin + tile_size, n_cols)))
+    return tiles
+
+# Runs function on every task, in a pool of n_processes (None for all cores) or in this process if n_processes is 1
+def _mapTasks(function, tasks, n_processes):
+    if n_processes == 1:
+        return [function(task) for task in tasks]
+    with multiprocessing.Pool(n_processes) as pool:
+        return list(pool.imap(function, tasks))
+
+##
+# Tiled version of map_transforms.getHighestNeighbor
+#
+def getHighestNeighborTiled(map_instance, radius=1.5, wrap=False, n_processes=None, tile_size=default_tile_size):
+    stencil = map_transforms.Stencil.fromMap(map_instance, radius, wrap)
+    tiles = getTiles(map_instance.getNumRows(), map_instance.getNumCols(), tile_size)
+    tiles_offset = _mapTasks(
+        map_transforms.getHighestNeighborOffset,
+        (stencil.getWindow(*tile) for tile in tiles),
+        n_processes,
+    )
+
+    gridded_highest_neighbor_offset = np.empty(map_instance.getDims(), dtype=np.int16)
+    for (ymin, ymax, xmin, xmax), tile_offset in zip(tiles, tiles_offset):
+        gridded_highest_neighbor_offset[ymin:ymax, xmin:xmax] = tile_offset
+
+    return map_instance.newChildInstance(
+        {'values': 'highest_neighbor'},
+        stencil.getNeighborIndex(gridded_highest_neighbor_offset).reshape(map_instance.getNumNodes()),
+    )
+
+##
+# Tiled version of map_transforms.getLocales
+#
+def getLocalesTiled(map_highest_neighbor_index, map_value=None, n_processes=None, tile_size=default_tile_size):
+    n_cols = map_highest_neighbor_index.getNumCols()
+    gridded_highest_neighbor_index = map_highest_neighbor_index.getDataMatrix()
+    tiles = getTiles(map_highest_neighbor_index.getNumRows(), n_cols, tile_size)
+    tiles_target = _mapTasks(
+        _getTileLocalTargets,
+        ((tile, n_cols, gridded_highest_neighbor_index[tile[0]:tile[1], tile[2]:tile[3]]) for tile in tiles),
+        n_processes,
+    )
+
+    # Each node now points either at its peak or at a node in another tile that is further along its path
+    gridded_target = np.empty(map_highest_neighbor_index.getDims(), dtype=gridded_highest_neighbor_index.dtype)
+    for (ymin, ymax, xmin, xmax), tile_target in zip(tiles, tiles_target):
+        gridded_target[ymin:ymax, xmin:xmax] = tile_target.reshape([ymax - ymin, xmax - xmin])
+
+    return map_transforms.getLocales(
+        map_highest_neighbor_index.newChildInstance({}, gridded_target.reshape(map_highest_neighbor_index.getNumNodes())),
+        map_value,
+    )
+
+# Follows the highest neighbors inside a tile, until reaching a peak or the last node in the tile
+# Returns the node each node ends up pointing at (the peak itself, or the node outside the tile)
+def _getTileLocalTargets(task):
+    (ymin, ymax, xmin, xmax), n_cols, tile_highest_neighbor_index = task
+    tile_n_cols = xmax - xmin
+    nodes_global_index = (np.arange(ymin, ymax).reshape([-1, 1]) * n_cols + np.arange(xmin, xmax).reshape([1, -1])).reshape(-1)
+    nodes_target = tile_highest_neighbor_index.reshape(-1).copy()
+    nodes_is_peak = nodes_target == -1
+    nodes_target[nodes_is_peak] = nodes_global_index[nodes_is_peak]
+
+    # Point each node to its target if that is in the tile, otherwise to itself
+    nodes_target_row = nodes_target // n_cols
+    nodes_target_col = nodes_target % n_cols
+    nodes_target_in_tile = (nodes_target_row >= ymin) & (nodes_target_row < ymax) & \
+        (nodes_target_col >= xmin) & (nodes_target_col < xmax)
+    nodes_next = np.where(
+        nodes_target_in_tile,
+        (nodes_target_row - ymin) * tile_n_cols + (nodes_target_col - xmin),
+        np.arange(len(nodes_target)),
+    )
+
+    # Pointer jumping until every node points to the last node of its path in the tile
+    while True:
+        nodes_next_cand = nodes_next[nodes_next]
+        if np.array_equal(nodes_next_cand, nodes_next):
+            break
+        nodes_next = nodes_next_cand
+
+    return nodes_target[nodes_next]
+
+##
+# Finds the neighbor pairs (explorer, neighbor slot) that can produce a merge in LocalePartition.computeDivisionMergePoints
+#
+# The merge sweep visits each node (explorer) from highest to lowest and each of its neighbors in order,
+# merging the two divisions when they are different. It is the same as building a spanning forest over the
+# locales, where every (explorer, neighbor) pair is an edge ordered by the explorer's rank and then the slot.
+# If a pair's two locales are already connected by earlier pairs within a tile, they are also connected by then
+# over the whole map, so that pair can never be a merge. Each tile runs the sweep on its own nodes and keeps only
+# the pairs that merged, and replaying the sweep over just those pairs gives exactly the same merges.
+#
+# Returns the candidate explorers & their neighbor slots in sweep order
+#
+def getMergeCandidates(nodes_index_hi_to_lo, nodes_locale, nodes_neighbors, n_rows, n_cols, n_processes=None, tile_size=default_tile_size):
+    nodes_rank = np.empty(len(nodes_index_hi_to_lo), dtype=nodes_neighbors.dtype)
+    nodes_rank[nodes_index_hi_to_lo] = np.arange(len(nodes_index_hi_to_lo))
+
+    def iterTasks():
+        for ymin, ymax, xmin, xmax in getTiles(n_rows, n_cols, tile_size):
+            tile_nodes = (np.arange(ymin, ymax).reshape([-1, 1]) * n_cols + np.arange(xmin, xmax).reshape([1, -1])).reshape(-1)
+            tile_nodes_neighbors = nodes_neighbors[tile_nodes]
+            tile_neighbors_locale = np.where(tile_nodes_neighbors != -1, nodes_locale[tile_nodes_neighbors], -1)
+            yield tile_nodes, nodes_rank[tile_nodes], nodes_locale[tile_nodes], tile_neighbors_locale
+
+    tiles_candidates = _mapTasks(_getTileMergeCandidates, iterTasks(), n_processes)
+    candidates_explorer = np.concatenate([tile_candidates[0] for tile_candidates in tiles_candidates])
+    candidates_slot = np.concatenate([tile_candidates[1] for tile_candidates in tiles_candidates])
+
+    candidates_order = np.lexsort((candidates_slot, nodes_rank[candidates_explorer]))
+    return candidates_explorer[candidates_order], candidates_slot[candidates_order]
+
+def _getTileMergeCandidates(task):
+    tile_nodes, tile_nodes_rank, tile_nodes_locale, tile_neighbors_locale = task
+    n_tile_nodes, n_nei = tile_neighbors_locale.shape
+
+    # Union-find over the locales seen by the tile, using plain lists since it is all single-element access
+    locales, locales_inverse = np.unique(
+        np.concatenate([tile_nodes_locale, tile_neighbors_locale.reshape(-1)]),
+        return_inverse=True,
+    )
+    explorers_locale = locales_inverse[:n_tile_nodes].tolist()
+    neighbors_locale = locales_inverse[n_tile_nodes:].reshape([n_tile_nodes, n_nei]).tolist()
+    neighbors_valid = (tile_neighbors_locale != -1).tolist()
+    locales_parent = list(range(len(locales)))
+
+    def find(locale):
+        while locales_parent[locale] != locale:
+            locales_parent[locale] = locales_parent[locales_parent[locale]] # path halving
+            locale = locales_parent[locale]
+        return locale
+
+    candidates_explorer = []
+    candidates_slot = []
+    for i_node in np.argsort(tile_nodes_rank).tolist():
+        explorer_root = find(explorers_locale[i_node])
+        for i_slot in range(n_nei):
+            if not neighbors_valid[i_node][i_slot]:
+                continue
+            neighbor_root = find(neighbors_locale[i_node][i_slot])
+            if neighbor_root == explorer_root:
+                continue
+            locales_parent[neighbor_root] = explorer_root
+            candidates_explorer.append(i_node)
+            candidates_slot.append(i_slot)
+
+    return tile_nodes[np.array(candidates_explorer, dtype=int)], np.array(candidates_slot, dtype=np.int8)
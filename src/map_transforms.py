@@ -1,5 +1,6 @@
 import numpy as np
 import math
+from src import map_dtypes
 
 ##
 # This computes the hillshade of an elevation map. The hillshade algorithm
@@ -30,7 +31,7 @@ def getHillshade(map_instance, radius=1):
 # Simple function but it will be used often
 #
 def getNodesIndex(map_instance):
-    return np.arange(map_instance.getNumNodes())
+    return map_dtypes.getNodesIndex(map_instance.getNumNodes())
 
 # Method to determine which nodes are at the edge of the map
 # It is useful for ignoring "neighboring" nodes that shouldn't be counted in algorithms
@@ -45,6 +46,54 @@ def getNodesOnMapEdge(map_instance):
     nodes_edge |= nodes_index >= ((num_rows - 1) * num_cols)
     return nodes_edge
     
+##
+# Orders the nodes by value, highest first (or lowest first), with ties in order of the node index
+#
+# Elevations are whole numbers (meters) in a bounded range, so rather than comparing values the nodes can be
+# bucketed by how far their value is from the first one: when those offsets fit in 16 bits numpy's stable sort
+# is a radix sort, which is O(n), and offsets up to 32 bits take 2 passes (the low 16 bits, then the high 16 bits).
+# Any other values fall back to a stable comparison sort, which gives the same order.
+#
+def getNodesOrder(nodes_value, descending=True):
+    nodes_value = np.asarray(nodes_value)
+    dtype = map_dtypes.getNodesIndexDtype(len(nodes_value))
+    nodes_key = _getIntegerOrderKeys(nodes_value, descending)
+    if nodes_key is None:
+        if not descending:
+            return np.argsort(nodes_value, kind='stable').astype(dtype, copy=False)
+        if nodes_value.dtype.kind == 'f':
+            return np.argsort(-nodes_value, kind='stable').astype(dtype, copy=False)
+        # Negating integers wraps around (unsigned values & the minimum signed value), so instead the reversed values
+        # are sorted lowest first, which reversed again is highest first with ties still in order of the node index
+        nodes_order = np.argsort(nodes_value[::-1], kind='stable')[::-1]
+        return (len(nodes_value) - 1 - nodes_order).astype(dtype, copy=False)
+
+    if len(nodes_key) == 0 or np.max(nodes_key) < 2**16:
+        return np.argsort(nodes_key.astype(np.uint16), kind='stable').astype(dtype, copy=False)
+    nodes_order = np.argsort((nodes_key & 0xFFFF).astype(np.uint16), kind='stable')
+    nodes_order = nodes_order[np.argsort((nodes_key >> 16).astype(np.uint16)[nodes_order], kind='stable')]
+    return nodes_order.astype(dtype, copy=False)
+
+# The offset of each value from the first value in the order, or None unless they're whole numbers within 32 bits
+def _getIntegerOrderKeys(nodes_value, descending):
+    if nodes_value.dtype.kind not in 'iuf' or len(nodes_value) == 0:
+        return None
+    value_min = np.min(nodes_value)
+    value_max = np.max(nodes_value)
+    if not (np.isfinite(value_min) and np.isfinite(value_max)) or float(value_max) - float(value_min) >= 2**32:
+        return None
+    if nodes_value.dtype.kind == 'f':
+        if max(abs(float(value_min)), abs(float(value_max))) >= 2**53 or not np.all(nodes_value == np.floor(nodes_value)):
+            return None
+        nodes_value = nodes_value.astype(np.int64)
+        value_min, value_max = np.int64(value_min), np.int64(value_max)
+
+    # Unsigned arithmetic wraps around, but the offsets are all under 2^32 so they come out right
+    nodes_value = nodes_value.astype(np.uint64)
+    if descending:
+        return (np.uint64(value_max) - nodes_value).astype(np.uint32)
+    return (nodes_value - np.uint64(value_min)).astype(np.uint32)
+
 ##
 # This function determines which neighboring node is the highest
 # Nodes with a value -1 have no higher neighbor.
@@ -52,40 +101,32 @@ def getNodesOnMapEdge(map_instance):
 # Default radius is 1.5, allowing for orthogonally and diagonally adjacent nodes
 #
 def getHighestNeighbor(map_instance, radius=1.5, wrap=False):
-    nodes_highest_neighbor_value_so_far = map_instance.getDataFlat()
-    nodes_highest_neighbor_index = np.full(map_instance.getNumNodes(), -1)
-    gridded_node_index = getNodesIndex(map_instance).reshape(map_instance.getDims())
-    gridded_value = map_instance.getDataMatrix()
-    nodes_on_map_edge = None
-    if (not wrap):
-        nodes_on_map_edge = getNodesOnMapEdge(map_instance)
-
-    rounded_radius = math.floor(radius)
-    for x in range(-rounded_radius, rounded_radius+1):
-        for y in range(-rounded_radius, rounded_radius+1):
-            # Only compute for neighboring edges under the radius
-            if((x == 0 and y == 0) or (x**2+y**2)**0.5 > radius):
-                continue
-                
-            # For neighboring nodes, find out if they are higher than the node
-            nodes_neighbor_value = np.roll(np.roll(gridded_value, x, 0), y, 1).flatten()
-            nodes_neighbor_is_higher = nodes_neighbor_value > nodes_highest_neighbor_value_so_far 
-
-            # Remove higher node designations for neighbors that are on the edge
-            if (not wrap):
-                nodes_neighbor_on_map_edge = np.roll(np.roll(nodes_on_map_edge.reshape(map_instance.getDims()), x, 0), y, 1).flatten()
-                nodes_neighbor_is_higher[nodes_neighbor_on_map_edge] = False
-
-            # Record the index of the higher neighboring node
-            nodes_neighbor_index = np.roll(np.roll(gridded_node_index, x, 0), y, 1).flatten()
-            nodes_highest_neighbor_index[nodes_neighbor_is_higher] = nodes_neighbor_index[nodes_neighbor_is_higher]
-            nodes_highest_neighbor_value_so_far[nodes_neighbor_is_higher] = nodes_neighbor_value[nodes_neighbor_is_higher]
-            
+    stencil = Stencil.fromMap(map_instance, radius, wrap)
     return map_instance.newChildInstance(
         {'values': 'highest_neighbor'},
-        nodes_highest_neighbor_index,
+        stencil.getNeighborIndex(getHighestNeighborOffset(stencil)).reshape(map_instance.getNumNodes()),
     )
 
+# Finds which offset of the stencil has the highest neighbor for each node (-1 if none are higher)
+def getHighestNeighborOffset(stencil):
+    gridded_highest_neighbor_value_so_far = np.array(stencil.getValues())
+    gridded_highest_neighbor_offset = np.full(stencil.getDims(), -1, dtype=np.int16)
+    gridded_neighbor_is_higher = np.empty(stencil.getDims(), dtype=bool)
+
+    for i_offset in range(stencil.getNumOffsets()):
+        # For neighboring nodes, find out if they are higher than the node
+        gridded_neighbor_value = stencil.getNeighborValues(i_offset)
+        np.greater(gridded_neighbor_value, gridded_highest_neighbor_value_so_far, out=gridded_neighbor_is_higher)
+
+        # Remove higher node designations for neighbors that are on the edge
+        stencil.removeNeighborsOnMapEdge(i_offset, gridded_neighbor_is_higher)
+
+        # Record which neighbor is higher, the index is computed once at the end
+        np.copyto(gridded_highest_neighbor_value_so_far, gridded_neighbor_value, where=gridded_neighbor_is_higher)
+        np.copyto(gridded_highest_neighbor_offset, i_offset, where=gridded_neighbor_is_higher)
+
+    return gridded_highest_neighbor_offset
+
 ##
 # Figures out the maximum point that a node points to along the curvature of the map
 #
@@ -95,34 +136,74 @@ def getHighestNeighbor(map_instance, radius=1.5, wrap=False):
 # Nodes are labeled by the index of their corresponding peak node
 #
 def getLocalPeaks(map_highest_neighbor_index, verbose=False):
-    nodes_local_peak = map_highest_neighbor_index.getDataFlat()
+    map_local_peak, _locales = getLocales(map_highest_neighbor_index, verbose=verbose)
+    return map_local_peak
+
+##
+# Same as getLocalPeaks, but also summarizes each locale (the area that flows to the same peak)
+#
+# Returns the map of local peaks and a dict of arrays with one value per locale, ordered by the peak index:
+#   extremum_index: the index of the peak
+#   n_nodes: number of nodes in the locale
+#   extremum_value: the value at the peak (only if map_value is given)
+#
+def getLocales(map_highest_neighbor_index, map_value=None, verbose=False):
+    nodes_local_peak = map_highest_neighbor_index.getDataFlat(copy=True)
     
     # Nodes without a higher neighbor are set to -1, but for this algorithm we want
     # to set them to the peak index
     nodes_index = getNodesIndex(map_highest_neighbor_index)
     nodes_local_peak[nodes_local_peak == -1] = nodes_index[nodes_local_peak == -1]
+    locales_extremum_index = np.flatnonzero(nodes_local_peak == nodes_index)
 
     if(verbose):
-        print(np.count_nonzero(nodes_local_peak == nodes_index), 'already peaks')
-
-    # A basic iterative approach but straightforward and simple and
-    # expected to run no more than O(nlogn) time because each iteration takes n time
-    # and the longest path is from the longest dimension of the map -- but since
-    # each iteration builds on the prior data, it should double the length of the 
-    # covered path each time
-    for i in range(map_highest_neighbor_index.getNumRows()):
-        nodes_local_peak_cand = nodes_local_peak[nodes_local_peak]
-        n_diff = np.count_nonzero(nodes_local_peak != nodes_local_peak_cand)
-        if(n_diff == 0):
-            continue
+        print(len(locales_extremum_index), 'already peaks')
+
+    # Pointer jumping: every round each node skips ahead to what its target points to, so the
+    # covered path doubles each time and it takes about log2 of the longest path in rounds.
+    # Only the nodes that don't point at a peak yet are updated, so the rounds get cheaper as they go
+    nodes_unresolved = np.flatnonzero(nodes_local_peak[nodes_local_peak] != nodes_local_peak)
+    while len(nodes_unresolved) > 0:
         if(verbose):
-            print(n_diff, 'updated')
-        nodes_local_peak = nodes_local_peak_cand
-        
-    return map_highest_neighbor_index.newChildInstance(
+            print(len(nodes_unresolved), 'updated')
+        nodes_local_peak[nodes_unresolved] = nodes_local_peak[nodes_local_peak[nodes_unresolved]]
+        nodes_unresolved_target = nodes_local_peak[nodes_unresolved]
+        nodes_unresolved = nodes_unresolved[nodes_local_peak[nodes_unresolved_target] != nodes_unresolved_target]
+
+    n_nodes = len(nodes_local_peak)
+    locales = {
+        'extremum_index': map_dtypes.asNodesIndex(locales_extremum_index, n_nodes),
+        'n_nodes': map_dtypes.asNodesIndex(np.bincount(nodes_local_peak, minlength=n_nodes)[locales_extremum_index], n_nodes),
+    }
+    if map_value is not None:
+        locales['extremum_value'] = map_value.getDataFlat()[locales_extremum_index]
+
+    map_local_peak = map_highest_neighbor_index.newChildInstance(
         {'values': 'local_peak'}, 
         nodes_local_peak
     )
+    return map_local_peak, locales
+
+##
+# Marks every node along the paths from the start nodes up to their local peaks (following the highest neighbors)
+#
+# nodes_on_path is updated in place. Nodes that are already on a path are not followed again, since everything
+# upward of them is already marked. The paths are followed one step at a time for all start nodes together,
+# so each node is visited at most once.
+#
+# Returns the indices of the newly marked nodes
+#
+def markPathsToPeaks(nodes_highest_neighbor_index, nodes_start, nodes_on_path):
+    nodes_frontier = np.unique(nodes_start)
+    nodes_newly_on_path = [nodes_frontier[:0]]
+    while len(nodes_frontier) > 0:
+        nodes_frontier = nodes_frontier[~nodes_on_path[nodes_frontier]]
+        nodes_on_path[nodes_frontier] = True
+        nodes_newly_on_path.append(nodes_frontier)
+
+        nodes_frontier = nodes_highest_neighbor_index[nodes_frontier]
+        nodes_frontier = np.unique(nodes_frontier[nodes_frontier != -1])
+    return np.concatenate(nodes_newly_on_path)
 
 ##
 # Determine which nodes have different values from their neighbors
@@ -130,91 +211,205 @@ def getLocalPeaks(map_highest_neighbor_index, verbose=False):
 # Usually, adjacent (radius=1) is sufficient
 #
 def getBorder(map_instance, radius=1, wrap=False):
-    nodes_value = map_instance.getDataFlat()
-    gridded_value = map_instance.getDataMatrix()
-    nodes_border = np.full(map_instance.getNumNodes(), False)
-    nodes_on_map_edge = None
-    if (not wrap):
-        nodes_on_map_edge = getNodesOnMapEdge(map_instance) 
-    
-    rounded_radius = math.floor(radius)
-    for x in range(-rounded_radius, rounded_radius+1):
-        for y in range(-rounded_radius, rounded_radius+1):
-            # Only compute for neighboring edges under the radius
-            if((x == 0 and y == 0) or (x**2+y**2)**0.5 > radius):
-                continue
-            
-            nodes_neighbor_value = np.roll(np.roll(gridded_value, x, 0), y, 1).flatten()
-            nodes_neighbor_is_different = nodes_neighbor_value != nodes_value 
+    stencil = Stencil.fromMap(map_instance, radius, wrap)
+    gridded_value = stencil.getValues()
+    gridded_border = np.zeros(map_instance.getDims(), dtype=bool)
+    gridded_neighbor_is_different = np.empty(map_instance.getDims(), dtype=bool)
+
+    for i_offset in range(stencil.getNumOffsets()):
+        np.not_equal(stencil.getNeighborValues(i_offset), gridded_value, out=gridded_neighbor_is_different)
+
+        # Remove border designations for neighbors that are on the edge
+        stencil.removeNeighborsOnMapEdge(i_offset, gridded_neighbor_is_different)
+
+        gridded_border |= gridded_neighbor_is_different
 
-            # Remove higher node designations for neighbors that are on the edge
-            if (not wrap):
-                nodes_neighbor_on_map_edge = np.roll(np.roll(nodes_on_map_edge.reshape(map_instance.getDims()), x, 0), y, 1).flatten()
-                nodes_neighbor_is_different[nodes_neighbor_on_map_edge] = False
-            
-            nodes_border[nodes_neighbor_is_different] = True
-            
     return map_instance.newChildInstance(
         {'mods': 'border'},
-        nodes_border,
+        gridded_border.reshape(map_instance.getNumNodes()),
     )
 
-def getNodesNeighbors(n_rows, n_cols, n_nei, wrap=False):
-    rc2index = lambda r, c: int(r * n_cols + c)
-    index2rc = lambda index: [int(index / n_cols), int(index % n_cols)]
-    nodes_neighbors = np.zeros([n_rows*n_cols, n_nei], dtype=int)
-    for row in np.arange(n_rows):
-        for col in np.arange(n_cols):
-            index = rc2index(row, col)
-            nodes_neighbors[index, 0] = rc2index(row - 1, col) if row > 0 else -1
-            nodes_neighbors[index, 1] = rc2index(row + 1, col) if row < n_rows-1 else -1
-            nodes_neighbors[index, 2] = rc2index(row, col - 1) if col > 0 else -1
-            nodes_neighbors[index, 3] = rc2index(row, col + 1) if col < n_cols-1 else -1
-            if(n_nei >= 8):
-                nodes_neighbors[index, 4] = rc2index(row - 1, col - 1) if row > 0   and col > 0   else -1
-                nodes_neighbors[index, 5] = rc2index(row + 1, col - 1) if row < n_rows-1 and col > 0   else -1
-                nodes_neighbors[index, 6] = rc2index(row - 1, col + 1) if row > 0   and col < n_cols-1 else -1
-                nodes_neighbors[index, 7] = rc2index(row + 1, col + 1) if row < n_rows-1 and col < n_cols-1 else -1
-            if(n_nei >= 20):
-                nodes_neighbors[index,  8] = rc2index(row - 2, col + 1) if row >= 0+2 and col <  n_cols-1 else -1
-                nodes_neighbors[index,  9] = rc2index(row - 2, col + 0) if row >= 0+2 and col >= 0+0 else -1
-                nodes_neighbors[index, 10] = rc2index(row - 2, col - 1) if row >= 0+2 and col >= 0+1 else -1
-                nodes_neighbors[index, 11] = rc2index(row - 1, col + 2) if row >= 0+1 and col <  n_cols-2 else -1
-                nodes_neighbors[index, 12] = rc2index(row - 1, col - 2) if row >= 0+1 and col >= 0+2 else -1
-                nodes_neighbors[index, 13] = rc2index(row + 0, col + 2) if row >= 0+0 and col <  n_cols-2 else -1
-                nodes_neighbors[index, 14] = rc2index(row + 0, col - 2) if row >= 0+0 and col >= 0+2 else -1
-                nodes_neighbors[index, 15] = rc2index(row + 1, col + 2) if row <  n_rows-1 and col <  n_cols-2 else -1
-                nodes_neighbors[index, 16] = rc2index(row + 1, col - 2) if row <  n_rows-1 and col >= 0+2 else -1
-                nodes_neighbors[index, 17] = rc2index(row + 2, col + 1) if row <  n_rows-2 and col <  n_cols-1 else -1
-                nodes_neighbors[index, 18] = rc2index(row + 2, col + 0) if row <  n_rows-2 and col >= 0+0 else -1
-                nodes_neighbors[index, 19] = rc2index(row + 2, col - 1) if row <  n_rows-2 and col >= 0+1 else -1
-
-            # Go over the edge of the world if appropriate
-            if(wrap):
-                if(col == 0):
-                    nodes_neighbors[index, 2] = rc2index(row, n_cols-1)
-                if(col == n_cols-1):
-                    nodes_neighbors[index, 3] = rc2index(row,   0)
-                if(n_nei >= 8):
-                    if(col == 0):
-                        nodes_neighbors[index, 4] = rc2index(row - 1, n_cols-1) if row > 0   else -1
-                        nodes_neighbors[index, 5] = rc2index(row + 1, n_cols-1) if row < n_rows-1 else -1
-                    if(col == n_cols-1):
-                        nodes_neighbors[index, 6] = rc2index(row - 1,   0) if row > 0   else -1
-                        nodes_neighbors[index, 7] = rc2index(row + 1,   0) if row < n_rows-1 else -1
-                if(n_nei >= 20):
-                    if(col == 0):
-                        nodes_neighbors[index, 10] = rc2index(row - 2, col + n_cols-1) if row >= 0+2 else -1
-                        nodes_neighbors[index, 19] = rc2index(row + 2, col + n_cols-1) if row <  n_rows-2 else -1
-                    if(col <= 1):
-                        nodes_neighbors[index, 12] = rc2index(row - 1, col + n_cols-2) if row >= 0+1 else -1
-                        nodes_neighbors[index, 14] = rc2index(row + 0, col + n_cols-2) if row >= 0+0 else -1
-                        nodes_neighbors[index, 16] = rc2index(row + 1, col + n_cols-2) if row <  n_rows-1 else -1
-                    if(col >= n_cols-2):
-                        nodes_neighbors[index, 11] = rc2index(row - 1, col - n_cols+2) if row >= 0+1 else -1
-                        nodes_neighbors[index, 13] = rc2index(row + 0, col - n_cols+2) if row >= 0+0 else -1
-                        nodes_neighbors[index, 15] = rc2index(row + 1, col - n_cols+2) if row <  n_rows-1 else -1
-                    if(col == n_cols-1):
-                        nodes_neighbors[index,  8] = rc2index(row - 2, col - n_cols+1) if row >= 0+2 else -1
-                        nodes_neighbors[index, 17] = rc2index(row + 2, col - n_cols+1) if row <  n_rows-2 else -1
+##
+# Helps compare each node to its neighbors within a radius, as used by getHighestNeighbor & getBorder
+#
+# The values are padded once on every side by the radius, so the values of the neighbor at some offset
+# for the whole map are just a slice (a view, no copy) of the padded values.
+# The padding wraps around the map like the original np.roll approach. When not wrapping, neighbors on
+# the edge of the map are excluded instead, using a padded mask of the nodes not on the edge.
+#
+# Offsets are visited in the same order as before, so ties are resolved the same way.
+# A stencil can also be cut down to a window of the map (see map_tiled) with the padding taken from the whole map.
+#
+class Stencil():
+    def __init__(self, padded_value, padded_not_on_map_edge, offsets, pad):
+        self.padded_value = padded_value
+        self.padded_not_on_map_edge = padded_not_on_map_edge # None when wrapping
+        self.offsets = offsets
+        self.pad = pad
+        self.n_rows = padded_value.shape[0] - 2 * pad
+        self.n_cols = padded_value.shape[1] - 2 * pad
+
+    @classmethod
+    def fromMap(cls, map_instance, radius, wrap):
+        pad = math.floor(radius)
+        offsets = []
+        for x in range(-pad, pad+1):
+            for y in range(-pad, pad+1):
+                # Only compute for neighboring edges under the radius
+                if((x == 0 and y == 0) or (x**2+y**2)**0.5 > radius):
+                    continue
+                # Rolling by (x, y) put the node at (row - x, col - y) in place
+                offsets.append((-x, -y))
+
+        padded_value = np.pad(map_instance.getDataMatrix(), pad, mode='wrap')
+        padded_not_on_map_edge = None
+        if (not wrap):
+            gridded_not_on_map_edge = ~getNodesOnMapEdge(map_instance).reshape(map_instance.getDims())
+            padded_not_on_map_edge = np.pad(gridded_not_on_map_edge, pad, mode='wrap')
+        return cls(padded_value, padded_not_on_map_edge, offsets, pad)
+
+    # The stencil for just the nodes in [ymin:ymax, xmin:xmax], with the padding around them taken from this stencil
+    def getWindow(self, ymin, ymax, xmin, xmax):
+        padded_window = (slice(ymin, ymax + 2 * self.pad), slice(xmin, xmax + 2 * self.pad))
+        return Stencil(
+            self.padded_value[padded_window],
+            self.padded_not_on_map_edge[padded_window] if self.padded_not_on_map_edge is not None else None,
+            self.offsets,
+            self.pad,
+        )
+
+    def getDims(self):
+        return [self.n_rows, self.n_cols]
+
+    def getValues(self):
+        return self.padded_value[self.pad:self.pad + self.n_rows, self.pad:self.pad + self.n_cols]
+
+    def getNumOffsets(self):
+        return len(self.offsets)
+
+    def _getNeighborSlice(self, i_offset):
+        row_offset, col_offset = self.offsets[i_offset]
+        return (
+            slice(self.pad + row_offset, self.pad + row_offset + self.n_rows),
+            slice(self.pad + col_offset, self.pad + col_offset + self.n_cols),
+        )
+
+    def getNeighborValues(self, i_offset):
+        return self.padded_value[self._getNeighborSlice(i_offset)]
+
+    # Sets gridded_mask to False where the neighbor is on the edge of the map (unless wrapping), in place
+    def removeNeighborsOnMapEdge(self, i_offset, gridded_mask):
+        if self.padded_not_on_map_edge is not None:
+            gridded_mask &= self.padded_not_on_map_edge[self._getNeighborSlice(i_offset)]
+        return gridded_mask
+
+    # Converts the chosen offset of each node (-1 for none) to the index of that neighbor (-1 for none)
+    def getNeighborIndex(self, gridded_offset):
+        dtype = map_dtypes.getNodesIndexDtype(self.n_rows * self.n_cols)
+        offsets = np.array(self.offsets + [(0, 0)], dtype=dtype)
+        gridded_row_offset = offsets[gridded_offset, 0] # -1 picks the last (0, 0) offset, fixed below
+        gridded_col_offset = offsets[gridded_offset, 1]
+        gridded_neighbor_index = (gridded_row_offset + np.arange(self.n_rows, dtype=dtype).reshape([self.n_rows, 1])) % self.n_rows
+        gridded_neighbor_index *= self.n_cols
+        gridded_neighbor_index += (gridded_col_offset + np.arange(self.n_cols, dtype=dtype).reshape([1, self.n_cols])) % self.n_cols
+        gridded_neighbor_index[gridded_offset == -1] = -1
+        return gridded_neighbor_index
+
+##
+# Offsets (row, col) to the neighbors of a node, in the column order of the neighbor table
+# The first 4 are orthogonal, the next 4 diagonal and the last 12 are the knight's moves & 2-away nodes
+#
+NEIGHBOR_OFFSETS = [
+    (-1,  0), ( 1,  0), ( 0, -1), ( 0,  1),
+    (-1, -1), ( 1, -1), (-1,  1), ( 1,  1),
+    (-2,  1), (-2,  0), (-2, -1), (-1,  2), (-1, -2), ( 0,  2),
+    ( 0, -2), ( 1,  2), ( 1, -2), ( 2,  1), ( 2,  0), ( 2, -1),
+]
+allowed_neighbor_counts = [4, 8, 20]
+
+def getNeighborOffsets(n_nei):
+    assert (n_nei in allowed_neighbor_counts), 'Number of neighbors must be one of: ' + str(allowed_neighbor_counts)
+    return NEIGHBOR_OFFSETS[:n_nei]
+
+##
+# Computes the index of one neighbor (at row_offset, col_offset) for every node
+# Neighbors that fall off the map are -1, unless wrap is set and they go over the left/right edge
+#
+def getNodesNeighborForOffset(n_rows, n_cols, row_offset, col_offset, wrap=False, dtype=None):
+    dtype = dtype if dtype is not None else map_dtypes.getNodesIndexDtype(n_rows * n_cols)
+    rows = np.arange(n_rows, dtype=dtype) + row_offset
+    cols = np.arange(n_cols, dtype=dtype) + col_offset
+    if wrap:
+        cols %= n_cols
+    rows_valid = (rows >= 0) & (rows < n_rows)
+    cols_valid = (cols >= 0) & (cols < n_cols)
+
+    gridded_neighbor = rows.reshape([n_rows, 1]) * n_cols + cols.reshape([1, n_cols])
+    gridded_neighbor[~rows_valid, :] = -1
+    gridded_neighbor[:, ~cols_valid] = -1
+    return gridded_neighbor.reshape(n_rows * n_cols)
+
+##
+# Lazy version of getNodesNeighbors -- yields the neighbor index of every node one offset at a time
+# so the whole [n_nodes, n_nei] table never has to be in memory at once
+#
+def iterNodesNeighbors(n_rows, n_cols, n_nei, wrap=False, dtype=None):
+    for row_offset, col_offset in getNeighborOffsets(n_nei):
+        yield getNodesNeighborForOffset(n_rows, n_cols, row_offset, col_offset, wrap=wrap, dtype=dtype)
+
+##
+# Builds the [n_nodes, n_nei] table of neighboring node indices, -1 where there is no neighbor
+#
+# Uses int32 indices when the map is small enough (anything under 2^31 nodes)
+#
+def getNodesNeighbors(n_rows, n_cols, n_nei, wrap=False, dtype=None):
+    dtype = dtype if dtype is not None else map_dtypes.getNodesIndexDtype(n_rows * n_cols)
+    nodes_neighbors = np.empty([n_rows * n_cols, n_nei], dtype=dtype)
+    for i_nei, nodes_neighbor in enumerate(iterNodesNeighbors(n_rows, n_cols, n_nei, wrap=wrap, dtype=dtype)):
+        nodes_neighbors[:, i_nei] = nodes_neighbor
     return nodes_neighbors
+
+##
+# Builds a compressed sparse row (CSR) adjacency list from a list of directed edges
+# The neighbors of node i are nodes_neighbor[offsets[i]:offsets[i+1]], kept in the order the edges were given
+#
+def getCompressedAdjacency(edges_from, edges_to, n_nodes):
+    edges_order = np.argsort(edges_from, kind='stable')
+    offsets = np.zeros(n_nodes + 1, dtype=map_dtypes.getNodesIndexDtype(len(edges_from)))
+    np.cumsum(np.bincount(edges_from, minlength=n_nodes), out=offsets[1:])
+    return offsets, edges_to[edges_order]
+
+# Gathers the neighbors of many nodes at once from a CSR adjacency list
+# Returns the neighbors and which of the given nodes each one came from
+def getCompressedNeighbors(offsets, nodes_neighbor, nodes):
+    n_neighbors = offsets[nodes + 1] - offsets[nodes]
+    neighbors_start = np.repeat(offsets[nodes] - (np.cumsum(n_neighbors) - n_neighbors), n_neighbors)
+    neighbors_position = neighbors_start + np.arange(np.sum(n_neighbors))
+    return nodes_neighbor[neighbors_position], np.repeat(nodes, n_neighbors)
+
+##
+# Hangs an undirected tree (or forest) from the given roots
+# Returns the parent of every node (-1 for the roots) and its depth (0 for the roots)
+#
+# Goes level by level from the roots, so each level is a handful of vectorized operations
+# and every node is visited only once
+#
+def getTreeParentAndDepth(offsets, nodes_neighbor, nodes_root):
+    n_nodes = len(offsets) - 1
+    nodes_parent = np.full(n_nodes, -1, dtype=map_dtypes.getNodesIndexDtype(n_nodes))
+    nodes_depth = np.full(n_nodes, -1, dtype=map_dtypes.getNodesIndexDtype(n_nodes))
+    nodes_depth[nodes_root] = 0
+
+    nodes_frontier = np.asarray(nodes_root)
+    depth = 0
+    while len(nodes_frontier) > 0:
+        depth += 1
+        neighbors, neighbors_from = getCompressedNeighbors(offsets, nodes_neighbor, nodes_frontier)
+
+        # In a tree, the only neighbor already explored is the node's own parent
+        neighbors_is_new = nodes_depth[neighbors] == -1
+        nodes_frontier = neighbors[neighbors_is_new]
+        nodes_parent[nodes_frontier] = neighbors_from[neighbors_is_new]
+        nodes_depth[nodes_frontier] = depth
+
+    return nodes_parent, nodes_depth